@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+#
+# Benchmark of the check_mongodb actions against the stand-in server of
+# fake_mongod.py. Every case is run as its own plugin process, so that the
+# numbers are those of a Nagios run: wall time (median of the runs), server
+# round trips and bytes received (from --round-trips) and the peak RSS of the
+# process. They are compared with the baselines and a regression makes the
+# run fail with exit code 1.
+#
+# Round trips and bytes received only change with the plugin, their baselines
+# are kept in baselines.json with the plugin and written by --update-shared.
+# Wall time and RSS depend on the machine and the Python and pymongo versions,
+# their baselines are kept in local_baselines.json (not in git) and written by
+# --update where the comparisons run.
+#
+
+import glob
+import json
+import optparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+from fake_mongod import FakeMongod
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = os.path.join(os.path.dirname(HERE), 'check_mongodb.py')
+BASELINES = os.path.join(HERE, 'baselines.json')
+LOCAL_BASELINES = os.path.join(HERE, 'local_baselines.json')
+
+# name: (databases, replica set members)
+SCENARIOS = {
+    'small': (1, 3),
+    'medium': (100, 7),
+    'large': (10000, 50),
+}
+
+# name: plugin arguments; every case runs once before it is measured, so the
+# numbers are those of a check whose caches are filled by earlier runs
+CASES = {
+    'connect': ['-A', 'connect'],
+    'connections': ['-A', 'connections'],
+    'memory': ['-A', 'memory'],
+    'replset_state': ['-A', 'replset_state'],
+    'replication_lag': ['-A', 'replication_lag'],
+    'databases': ['-A', 'databases', '-W', '20000', '-C', '30000'],
+    'database_size': ['-A', 'database_size', '-d', 'db00000'],
+    'all_databases_size': ['-A', 'database_size', '--all-databases', '-W', '100000', '-C', '200000'],
+    'all_databases_size_uncached': ['-A', 'database_size', '--all-databases', '--db-stats-ttl', '0', '-W', '100000', '-C', '200000'],
+    'collection_size': ['-A', 'collection_size', '-d', 'db00000', '-c', 'c0'],
+    'several_actions': ['-A', 'connections', '--actions', 'memory,replset_state,databases:20000:30000'],
+}
+
+METRICS = ('wall_ms', 'round_trips', 'bytes_received', 'max_rss_kb')
+# the metrics of the baselines kept with the plugin, the others are local
+SHARED_METRICS = ('round_trips', 'bytes_received')
+LOCAL_METRICS = ('wall_ms', 'max_rss_kb')
+
+
+def run_plugin(python, port, arguments):
+    """ Run the plugin once, return (state, output, seconds, peak RSS in KB) """
+    command = [python, PLUGIN, '-H', '127.0.0.1', '-P', str(port), '--round-trips'] + arguments
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    process.stdout.close()
+    # wait4 gives the resource usage of this one child
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    max_rss = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss //= 1024
+    return process.returncode, output.decode('utf-8', 'replace'), seconds, max_rss
+
+
+def performance_value(output, label):
+    match = re.search(r"(?:^|\s|\|)%s=(\d+)" % re.escape(label), output.split('\n')[0])
+    return int(match.group(1)) if match else None
+
+
+def run_case(python, port, arguments, runs):
+    """ Run a case once to warm up the plugin's caches, then runs times """
+    run_plugin(python, port, arguments)
+    results = [run_plugin(python, port, arguments) for i in range(runs)]
+    state, output = results[-1][:2]
+    walls = sorted(seconds for state, output, seconds, max_rss in results)
+    return state, output, {
+        'wall_ms': round(walls[len(walls) // 2] * 1000, 1),
+        'round_trips': max(performance_value(output, 'round_trips') or 0 for state, output, seconds, max_rss in results),
+        'bytes_received': max(performance_value(output, 'bytes_received') or 0 for state, output, seconds, max_rss in results),
+        'max_rss_kb': max(max_rss for state, output, seconds, max_rss in results),
+    }
+
+
+def regressions(numbers, baseline, options):
+    """ Describe where numbers are worse than baseline """
+    found = []
+    limits = {
+        'wall_ms': baseline.get('wall_ms', 0) * (1 + options.wall_tolerance) + options.wall_slack,
+        'round_trips': baseline.get('round_trips', 0),
+        'bytes_received': baseline.get('bytes_received', 0) * 1.1,
+        'max_rss_kb': baseline.get('max_rss_kb', 0) * (1 + options.rss_tolerance),
+    }
+    for metric in METRICS:
+        if metric in baseline and numbers[metric] > limits[metric]:
+            found.append("%s %s > %s (baseline %s)" % (metric, numbers[metric], round(limits[metric], 1), baseline[metric]))
+    return found
+
+
+def load_baselines(file_name):
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def save_baselines(file_name, baselines):
+    with open(file_name, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def cleanup_state(port):
+    """ Remove the state the plugin kept for the server on port """
+    for file_name in glob.glob("/tmp/check_mongodb_data/127.0.0.1-%s-*" % port):
+        os.remove(file_name)
+
+
+def main(argv):
+    p = optparse.OptionParser(usage="%prog [options]", description="Benchmark the check_mongodb actions against a stand-in mongod")
+    p.add_option('-s', '--scenarios', action='store', type='string', dest='scenarios', default='small,medium,large', help='Comma separated scenarios to run out of %s' % ', '.join(sorted(SCENARIOS)))
+    p.add_option('-a', '--cases', action='store', type='string', dest='cases', default=None, help='Comma separated cases to run (default all: %s)' % ', '.join(sorted(CASES)))
+    p.add_option('--databases', action='store', type='int', dest='databases', default=None, help='Run a custom scenario with this many databases instead')
+    p.add_option('--members', action='store', type='int', dest='members', default=3, help='Replica set members of the custom scenario')
+    p.add_option('-n', '--runs', action='store', type='int', dest='runs', default=5, help='Measured runs per case')
+    p.add_option('--python', action='store', type='string', dest='python', default=sys.executable, help='Python interpreter to run the plugin with')
+    p.add_option('--baselines', action='store', type='string', dest='baselines', default=BASELINES, help='The baselines file of the round trips and bytes received')
+    p.add_option('--local-baselines', action='store', type='string', dest='local_baselines', default=LOCAL_BASELINES, help='The baselines file of the wall time and peak RSS of this machine')
+    p.add_option('--update', action='store_true', dest='update', default=False, help='Write the wall time and peak RSS measured to the local baselines file instead of comparing them')
+    p.add_option('--update-shared', action='store_true', dest='update_shared', default=False, help='Write the round trips and bytes received measured to the baselines file instead of comparing them')
+    p.add_option('--wall-tolerance', action='store', type='float', dest='wall_tolerance', default=0.5, help='Allowed relative increase of the wall time')
+    p.add_option('--wall-slack', action='store', type='float', dest='wall_slack', default=20, help='Allowed absolute increase of the wall time in milliseconds')
+    p.add_option('--rss-tolerance', action='store', type='float', dest='rss_tolerance', default=0.2, help='Allowed relative increase of the peak RSS')
+    options, arguments = p.parse_args(argv)
+
+    if options.databases:
+        scenarios = [("custom_%d_%d" % (options.databases, options.members), (options.databases, options.members))]
+    else:
+        names = options.scenarios.split(',')
+        unknown = [name for name in names if name not in SCENARIOS]
+        if unknown:
+            p.error("unknown scenario %s" % ', '.join(unknown))
+        scenarios = [(name, SCENARIOS[name]) for name in names]
+    cases = options.cases.split(',') if options.cases else sorted(CASES)
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        p.error("unknown case %s" % ', '.join(unknown))
+
+    shared_baselines = load_baselines(options.baselines)
+    local_baselines = load_baselines(options.local_baselines)
+
+    failed = []
+    print("%-10s %-28s %5s %10s %11s %14s %12s" % ('scenario', 'case', 'state', 'wall_ms', 'round_trips', 'bytes_received', 'max_rss_kb'))
+    for scenario, (databases, members) in scenarios:
+        try:
+            server = FakeMongod(0, databases, members).start()
+        except ValueError as e:
+            p.error(str(e))
+        port = server.server_address[1]
+        try:
+            for case in cases:
+                state, output, numbers = run_case(options.python, port, CASES[case], options.runs)
+                print("%-10s %-28s %5s %10.1f %11d %14d %12d" % (scenario, case, state, numbers['wall_ms'], numbers['round_trips'], numbers['bytes_received'], numbers['max_rss_kb']))
+                if state == 3 or not numbers['round_trips']:
+                    failed.append("%s %s: the check did not run: %s" % (scenario, case, output.strip()))
+                baseline = {}
+                for baselines, metrics, update in ((shared_baselines, SHARED_METRICS, options.update_shared),
+                                                   (local_baselines, LOCAL_METRICS, options.update)):
+                    if update:
+                        baselines.setdefault(scenario, {})[case] = dict((metric, numbers[metric]) for metric in metrics)
+                    else:
+                        baseline.update((metric, value) for metric, value in baselines.get(scenario, {}).get(case, {}).items() if metric in metrics)
+                failed += ["%s %s: %s" % (scenario, case, found) for found in regressions(numbers, baseline, options)]
+                sys.stdout.flush()
+        finally:
+            server.shutdown()
+            server.server_close()
+            cleanup_state(port)
+
+    if options.update_shared:
+        save_baselines(options.baselines, shared_baselines)
+    if options.update:
+        save_baselines(options.local_baselines, local_baselines)
+    if failed:
+        print("")
+        print("\n".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
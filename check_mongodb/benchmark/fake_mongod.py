@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+#
+# A stand-in for mongod speaking just enough of the wire protocol (OP_QUERY,
+# OP_MSG, zlib OP_COMPRESSED) to answer the commands check_mongodb sends for
+# the benchmarked actions: ismaster/hello, ping, buildInfo, hostInfo,
+# endSessions, serverStatus, replSetGetStatus, listDatabases, dbStats,
+# collStats and a find of the replica set configuration. The number of
+# databases and replica set members is configurable so that the size of the
+# replies can be scaled up.
+#
+# The large replies are encoded once when the server starts, so that the cost
+# measured is the one of the check and not the one of this server.
+#
+
+import datetime
+import optparse
+import struct
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import bson
+from bson.timestamp import Timestamp
+
+OP_REPLY = 1
+OP_QUERY = 2004
+OP_COMPRESSED = 2012
+OP_MSG = 2013
+ZLIB = 2
+
+MAX_DATABASES = 10000
+MAX_MEMBERS = 50
+
+
+def encode(document):
+    return bson.BSON.encode(document)
+
+
+def decode(data):
+    return bson.BSON(data).decode()
+
+
+class FakeMongod(socketserver.ThreadingTCPServer):
+    """ The server, run it with serve_forever() or start() for a background
+    thread. port 0 picks a free port, see address. """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0, databases=1, members=3, version='5.0.14'):
+        if not 1 <= databases <= MAX_DATABASES:
+            raise ValueError("databases must be between 1 and %d" % MAX_DATABASES)
+        if not 3 <= members <= MAX_MEMBERS:
+            raise ValueError("members must be between 3 and %d" % MAX_MEMBERS)
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), RequestHandler)
+        self.databases = databases
+        self.members = members
+        self.version = version
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.replies = self.build_replies()
+
+    @property
+    def address(self):
+        return "%s:%s" % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def database_names(self):
+        return ['db%05d' % i for i in range(self.databases)]
+
+    def member_names(self):
+        return [self.address] + ['10.0.%d.%d:27017' % (i // 250, i % 250 + 1) for i in range(1, self.members)]
+
+    def build_replies(self):
+        """ Encode the replies depending only on the size of the deployment """
+        now = datetime.datetime.utcfromtimestamp(int(self.started))
+        databases = [{'name': name, 'sizeOnDisk': (i + 1) << 20, 'empty': False} for i, name in enumerate(self.database_names())]
+        members = []
+        for i, name in enumerate(self.member_names()):
+            lag = i % 10
+            member = {'_id': i, 'name': name, 'health': 1.0, 'state': 2 if i else 1,
+                      'stateStr': 'SECONDARY' if i else 'PRIMARY', 'uptime': 86400,
+                      'optime': {'ts': Timestamp(int(self.started) - lag, 1), 't': 1},
+                      'optimeDate': now - datetime.timedelta(seconds=lag)}
+            if i:
+                member.update({'lastHeartbeat': now, 'pingMs': 1, 'syncSourceHost': self.address})
+            else:
+                member['self'] = True
+            members.append(member)
+        config = {'_id': 'rs0', 'version': 1, 'protocolVersion': 1,
+                  'members': [{'_id': i, 'host': name, 'priority': 1.0, 'votes': 1 if i < 7 else 0}
+                              for i, name in enumerate(self.member_names())]}
+        return {
+            'replset_config': encode({'cursor': {'id': 0, 'ns': 'local.system.replset', 'firstBatch': [config]}, 'ok': 1.0}),
+            'listdatabases': encode({'databases': databases, 'totalSize': sum(d['sizeOnDisk'] for d in databases), 'ok': 1.0}),
+            'listdatabases_nameonly': encode({'databases': [{'name': d['name']} for d in databases], 'ok': 1.0}),
+            'replsetgetstatus': encode({'set': 'rs0', 'date': now, 'myState': 1, 'members': members, 'ok': 1.0}),
+        }
+
+    def dispatch(self, command):
+        """ The encoded reply to a command document """
+        name = next(iter(command))
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+        method = getattr(self, 'cmd_' + name.lower(), None)
+        if method is None:
+            return encode({'ok': 0.0, 'errmsg': "no such command: '%s'" % name, 'code': 59, 'codeName': 'CommandNotFound'})
+        reply = method(command)
+        if isinstance(reply, dict):
+            reply = encode(reply)
+        return reply
+
+    def cmd_ismaster(self, command):
+        reply = {'ismaster': True, 'isWritablePrimary': True, 'secondary': False, 'setName': 'rs0', 'setVersion': 1,
+                 'hosts': [self.address], 'primary': self.address, 'me': self.address,
+                 'maxBsonObjectSize': 16777216, 'maxMessageSizeBytes': 48000000, 'maxWriteBatchSize': 100000,
+                 'localTime': datetime.datetime.utcnow(), 'logicalSessionTimeoutMinutes': 30, 'connectionId': 1,
+                 'minWireVersion': 0, 'maxWireVersion': 13, 'ok': 1.0}
+        if 'compression' in command:
+            reply['compression'] = [name for name in command['compression'] if name == 'zlib']
+        return reply
+
+    cmd_hello = cmd_ismaster
+
+    def cmd_ping(self, command):
+        return {'ok': 1.0}
+
+    cmd_endsessions = cmd_ping
+
+    def cmd_buildinfo(self, command):
+        return {'version': self.version, 'versionArray': [int(part) for part in self.version.split('.')] + [0], 'ok': 1.0}
+
+    def cmd_hostinfo(self, command):
+        return {'system': {'hostname': 'fake', 'memSizeMB': 32768, 'numCores': 8}, 'os': {'type': 'Linux'}, 'extra': {}, 'ok': 1.0}
+
+    def cmd_serverstatus(self, command):
+        uptime = time.time() - self.started + 86400
+        ops = int(uptime * 100)
+        return {'host': 'fake', 'version': self.version, 'process': 'mongod', 'uptime': uptime, 'uptimeMillis': int(uptime * 1000),
+                'localTime': datetime.datetime.utcnow(),
+                'asserts': {'regular': 0, 'warning': 0, 'msg': 0, 'user': 5, 'rollovers': 0},
+                'connections': {'current': 10, 'available': 990, 'totalCreated': 100},
+                'extra_info': {'page_faults': ops // 100},
+                'globalLock': {'totalTime': int(uptime * 1e6), 'currentQueue': {'total': 1, 'readers': 1, 'writers': 0},
+                               'activeClients': {'total': 10, 'readers': 5, 'writers': 5}},
+                'mem': {'bits': 64, 'resident': 2048, 'virtual': 4096, 'supported': True},
+                'network': {'bytesIn': ops * 10, 'bytesOut': ops * 20, 'numRequests': ops},
+                'opcounters': {'insert': ops, 'query': ops * 2, 'update': ops, 'delete': 0, 'getmore': 0, 'command': ops * 3},
+                'opcountersRepl': {'insert': 0, 'query': 0, 'update': 0, 'delete': 0, 'getmore': 0, 'command': 0},
+                'repl': {'setName': 'rs0', 'ismaster': True, 'secondary': False, 'primary': self.address, 'me': self.address,
+                         'hosts': self.member_names()},
+                'wiredTiger': {'cache': {'bytes currently in the cache': 1 << 30, 'maximum bytes configured': 4 << 30}},
+                'ok': 1.0}
+
+    def cmd_replsetgetstatus(self, command):
+        return self.replies['replsetgetstatus']
+
+    def cmd_find(self, command):
+        if command['$db'] == 'local' and command['find'] == 'system.replset':
+            return self.replies['replset_config']
+        return {'cursor': {'id': 0, 'ns': "%s.%s" % (command['$db'], command['find']), 'firstBatch': []}, 'ok': 1.0}
+
+    def cmd_listdatabases(self, command):
+        if command.get('nameOnly'):
+            return self.replies['listdatabases_nameonly']
+        return self.replies['listdatabases']
+
+    def cmd_dbstats(self, command):
+        return {'db': command['$db'], 'collections': 3, 'views': 0, 'objects': 3000, 'avgObjSize': 1024.0,
+                'dataSize': 3 << 20, 'storageSize': 4 << 20, 'indexes': 6, 'indexSize': 1 << 20, 'ok': 1.0}
+
+    def cmd_collstats(self, command):
+        return {'ns': "%s.%s" % (command['$db'], command[next(iter(command))]), 'count': 1000, 'size': 1 << 20,
+                'avgObjSize': 1024, 'storageSize': 4 << 20, 'nindexes': 2, 'totalIndexSize': 1 << 19,
+                'indexSizes': {'_id_': 1 << 18, 'a_1': 1 << 18}, 'ok': 1.0}
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+
+    def read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def handle(self):
+        try:
+            while True:
+                length, request_id, response_to, opcode = struct.unpack('<iiii', self.read(16))
+                body = self.read(length - 16)
+                compressed = opcode == OP_COMPRESSED
+                if compressed:
+                    opcode, size, compressor = struct.unpack('<iiB', body[:9])
+                    body = zlib.decompress(body[9:])
+                if opcode == OP_QUERY:
+                    # flags, collection name, skip and limit, then the query
+                    end = body.index(b'\0', 4)
+                    database = body[4:end].decode('utf-8').split('.')[0]
+                    start = end + 9
+                    command = decode(body[start:start + struct.unpack('<i', body[start:start + 4])[0]])
+                    command = command.get('$query', command)
+                    command['$db'] = database
+                    reply = struct.pack('<iqii', 0, 0, 0, 1) + self.server.dispatch(command)
+                    reply_opcode = OP_REPLY
+                elif opcode == OP_MSG:
+                    # flag bits and the section of kind 0 holding the command
+                    command = None
+                    position = 4
+                    while position < len(body) - 4 * (struct.unpack('<I', body[:4])[0] & 1):
+                        kind = ord(body[position:position + 1])
+                        size = struct.unpack('<i', body[position + 1:position + 5])[0]
+                        if kind == 0:
+                            command = decode(body[position + 1:position + 1 + size])
+                        position += 1 + size
+                    reply = struct.pack('<IB', 0, 0) + self.server.dispatch(command)
+                    reply_opcode = OP_MSG
+                else:
+                    return
+                if compressed:
+                    reply = struct.pack('<iiB', reply_opcode, len(reply), ZLIB) + zlib.compress(reply)
+                    reply_opcode = OP_COMPRESSED
+                self.request.sendall(struct.pack('<iiii', 16 + len(reply), 0, request_id, reply_opcode) + reply)
+        except (EOFError, IOError):
+            pass
+
+
+def main(argv):
+    p = optparse.OptionParser(usage="%prog [options]", description="Serve a stand-in mongod for benchmarking check_mongodb")
+    p.add_option('-P', '--port', action='store', type='int', dest='port', default=27999, help='The port to listen on, 0 for any free port')
+    p.add_option('--databases', action='store', type='int', dest='databases', default=1, help='Number of databases listed (1 to %d)' % MAX_DATABASES)
+    p.add_option('--members', action='store', type='int', dest='members', default=3, help='Number of replica set members (3 to %d)' % MAX_MEMBERS)
+    options, arguments = p.parse_args(argv)
+    try:
+        server = FakeMongod(options.port, options.databases, options.members)
+    except ValueError as e:
+        p.error(str(e))
+    print("listening on %s" % server.address)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -30,11 +30,35 @@ from __future__ import print_function
 from __future__ import division
 import sys
 import time
+import calendar
+import copy
+import datetime
+import errno
 import optparse
 import re
 import os
 import numbers
+import signal
 import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 try:
     import pymongo
@@ -115,14 +139,149 @@ def check_levels(param, warning, critical, message, ok=[]):
         return 2
 
 
+#
+# serverStatus documents shared by all actions checked in one run, keyed by
+# connection. Only connections registered here (value None until the first
+# fetch) share their document, everything else queries the server each time.
+#
+server_status_snapshots = {}
+
+#
+# On-disk serverStatus caches shared between concurrent runs, keyed by
+# connection: (cache file name, ttl in seconds).
+#
+server_status_caches = {}
+
+#
+# Large serverStatus sections which are only requested if an action needs
+# them, and the ones each action needs. Every action reading serverStatus
+# must be listed in SERVER_STATUS_SECTIONS: actions not listed are taken not
+# to read it and get no optional section (counter_rate derives them from
+# --counters).
+#
+SERVER_STATUS_OPTIONAL_SECTIONS = ['wiredTiger', 'tcmalloc', 'metrics', 'locks', 'repl', 'opLatencies', 'transactions', 'electionMetrics',
+                                   'flowControl', 'logicalSessionRecordCache', 'shardingStatistics', 'catalogStats', 'security']
+
+SERVER_STATUS_SECTIONS = {
+    'connections': [], 'memory': [], 'memory_mapped': [], 'queues': [], 'lock': [], 'current_lock': [], 'flushing': [],
+    'last_flush_time': [], 'index_miss_ratio': [], 'journal_commits_in_wl': [], 'write_data_files': [], 'journaled': [],
+    'opcounters': [], 'page_faults': [], 'asserts': [], 'queries_per_second': [], 'replica_primary': ['repl'],
+}
+
+#
+# Optional sections the actions run on a connection need, keyed by
+# connection. None or no entry means the complete document.
+#
+server_status_sections = {}
+
+
+def needed_server_status_sections(actions, options):
+    """ Return the optional serverStatus sections needed by actions, or None if
+    (one of) the actions may need the complete document. Actions not listed in
+    SERVER_STATUS_SECTIONS do not read serverStatus themselves; the server
+    uptime validating cached metadata needs no optional section. """
+    sections = set()
+    for action in actions:
+        if action == 'counter_rate':
+            if not options.counters:
+                return None
+            sections.update(name.strip().split('.')[0] for name in options.counters.split(','))
+        elif action in SERVER_STATUS_SECTIONS:
+            sections.update(SERVER_STATUS_SECTIONS[action])
+    return sections
+
+
 def get_server_status(con):
+    data = server_status_snapshots.get(id(con))
+    if data is not None:
+        return data
+    sections = server_status_sections.get(id(con))
+    if id(con) in server_status_caches:
+        file_name, ttl = server_status_caches[id(con)]
+        data = get_cached_server_status(con, file_name, ttl, sections)
+    else:
+        data = fetch_server_status(con, sections)
+    if id(con) in server_status_snapshots:
+        server_status_snapshots[id(con)] = data
+    return data
+
+
+def excluded_server_status_sections(sections):
+    if sections is None:
+        return []
+    return [section for section in SERVER_STATUS_OPTIONAL_SECTIONS if section not in sections]
+
+
+def fetch_server_status(con, sections=None):
+    """ Run serverStatus, leaving out the optional sections not in sections """
+    command = [('serverStatus', 1)] + [(section, 0) for section in excluded_server_status_sections(sections)]
     try:
-        set_read_preference(con.admin)
-        data = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
+        data = con.admin.command(pymongo.son_manipulator.SON(command))
     except:
-        data = con.admin.command(son.SON([('serverStatus', 1)]))
+        data = con.admin.command(son.SON(command))
+    return data
+
+
+def enable_server_status_cache(con, host, port, ttl):
+    """ Share serverStatus of host:port with other runs for ttl seconds """
+    file_name = build_file_name(host, port, "serverStatus", "bson")
+    server_status_caches[id(con)] = (file_name, ttl)
+
+
+def read_cached_server_status(file_name):
+    """ Return (age in seconds, excluded sections, serverStatus) of the cache file """
+    import bson
+    try:
+        age = time.time() - os.path.getmtime(file_name)
+        f = open(file_name, 'rb')
+        try:
+            cached = bson.BSON(f.read()).decode()
+        finally:
+            f.close()
+        return age, set(cached['excluded']), cached['status']
+    except (IOError, OSError, KeyError, bson.errors.BSONError):
+        return None
+
+
+def cache_covers(cached, ttl, sections):
+    if cached is None or cached[0] > ttl:
+        return False
+    return not cached[1].intersection(SERVER_STATUS_OPTIONAL_SECTIONS if sections is None else sections)
+
+
+def get_cached_server_status(con, file_name, ttl, sections=None):
+    """ Return a serverStatus document not older than ttl seconds containing
+    sections. Only one process refreshes an expired snapshot, the others
+    wait for its result. """
+    import bson
+    cached = read_cached_server_status(file_name)
+    if cache_covers(cached, ttl, sections):
+        return cached[2]
+
+    ensure_dir(file_name)
+    lock = open(file_name + ".lock", 'a')
+    try:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # somebody else may have refreshed it while we waited for the lock
+        cached = read_cached_server_status(file_name)
+        if cache_covers(cached, ttl, sections):
+            return cached[2]
+        if sections is not None and cached is not None:
+            # keep the sections the other checks of this host needed
+            sections = set(sections).union(set(SERVER_STATUS_OPTIONAL_SECTIONS) - cached[1])
+        data = fetch_server_status(con, sections)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(file_name))
+        try:
+            os.write(fd, bson.BSON.encode({'excluded': excluded_server_status_sections(sections), 'status': data}))
+        finally:
+            os.close(fd)
+        os.rename(tmp_name, file_name)
+    finally:
+        lock.close()
     return data
 
+
 def split_host_port(string):
     if not string.rsplit(':', 1)[-1].isdigit():
         return (string, None)
@@ -132,12 +291,20 @@ def split_host_port(string):
     return (host, port)
 
 
-def main(argv):
+ACTIONS = ['connect', 'connections', 'replication_lag', 'replication_lag_percent', 'replset_state', 'memory', 'memory_mapped', 'lock',
+           'flushing', 'last_flush_time', 'index_miss_ratio', 'databases', 'collections', 'database_size', 'database_indexes', 'collection_documents', 'collection_indexes', 'collection_size',
+           'collection_storageSize', 'queues', 'oplog', 'oplog_throughput', 'journal_commits_in_wl', 'write_data_files', 'journaled', 'opcounters', 'current_lock', 'replica_primary',
+           'page_faults', 'asserts', 'queries_per_second', 'page_faults', 'chunks_balance', 'connect_primary', 'collection_state', 'row_count', 'replset_quorum',
+           'counter_rate', 'replset_members']
+
+
+def build_parser():
     p = optparse.OptionParser(conflict_handler="resolve", description="This Nagios plugin checks the health of mongodb.")
 
     p.add_option('-H', '--host', action='store', type='string', dest='host', default='127.0.0.1', help='The hostname you want to connect to')
     p.add_option('-h', '--host-to-check', action='store', type='string', dest='host_to_check', default=None, help='The hostname you want to check (if this is different from the host you are connecting)')
     p.add_option('--rdns-lookup', action='store_true', dest='rdns_lookup', default=False, help='RDNS(PTR) lookup on given host/host-to-check, to convert ip-address to fqdn')
+    p.add_option('--rdns-cache-ttl', action='store', type='int', dest='rdns_cache_ttl', default=3600, help='Seconds the names found by --rdns-lookup are reused by later checks (0 disables the cache)')
     p.add_option('-P', '--port', action='store', type='int', dest='port', default=27017, help='The port mongodb is running on')
     p.add_option('--port-to-check', action='store', type='int', dest='port_to_check', default=None, help='The port you want to check (if this is different from the port you are connecting)')
     p.add_option('-u', '--user', action='store', type='string', dest='user', default=None, help='The username you want to login as')
@@ -145,20 +312,36 @@ def main(argv):
     p.add_option('-W', '--warning', action='store', dest='warning', default=None, help='The warning threshold you want to set')
     p.add_option('-C', '--critical', action='store', dest='critical', default=None, help='The critical threshold you want to set')
     p.add_option('-A', '--action', action='store', type='choice', dest='action', default='connect', help='The action you want to take',
-                 choices=['connect', 'connections', 'replication_lag', 'replication_lag_percent', 'replset_state', 'memory', 'memory_mapped', 'lock',
-                          'flushing', 'last_flush_time', 'index_miss_ratio', 'databases', 'collections', 'database_size', 'database_indexes', 'collection_documents', 'collection_indexes', 'collection_size',
-                          'collection_storageSize', 'queues', 'oplog', 'journal_commits_in_wl', 'write_data_files', 'journaled', 'opcounters', 'current_lock', 'replica_primary',
-                          'page_faults', 'asserts', 'queries_per_second', 'page_faults', 'chunks_balance', 'connect_primary', 'collection_state', 'row_count', 'replset_quorum'])
+                 choices=ACTIONS)
+    p.add_option('--actions', action='store', type='string', dest='actions', default=None, help='Comma separated list of actions (each optionally followed by :warning:critical) to check using a single connection and serverStatus')
     p.add_option('--max-lag', action='store_true', dest='max_lag', default=False, help='Get max replication lag (for replication_lag action only)')
+    p.add_option('--oplog-window-ttl', action='store', type='int', dest='oplog_window_ttl', default=900, help='Seconds between reads of the first oplog entry, which gives the oplog window together with the current last entry (oplog, oplog_throughput and replication_lag_percent)')
+    p.add_option('--passive-command-file', action='store', type='string', dest='passive_command_file', default=None, help='Nagios command file to submit the result of every member as passive check to (replset_members)')
+    p.add_option('--passive-service', action='store', type='string', dest='passive_service', default='Mongo Replica Set Member', help='Service description of the passive checks of the members (replset_members)')
     p.add_option('--mapped-memory', action='store_true', dest='mapped_memory', default=False, help='Get mapped memory instead of resident (if resident memory can not be read)')
     p.add_option('-D', '--perf-data', action='store_true', dest='perf_data', default=False, help='Enable output of Nagios performance data')
     p.add_option('-d', '--database', action='store', dest='database', default='admin', help='Specify the database to check')
     p.add_option('--all-databases', action='store_true', dest='all_databases', default=False, help='Check all databases (action database_size)')
+    p.add_option('--top', action='store', type='int', dest='top', default=10, help='Number of the largest databases reported with --all-databases')
+    p.add_option('--db-workers', action='store', type='int', dest='db_workers', default=8, help='Number of databases queried at the same time (database_size --all-databases, collections)')
+    p.add_option('--db-stats-ttl', action='store', type='int', dest='db_stats_ttl', default=300, help='Seconds the stats of a database are reused by later checks before they get refreshed (0 disables the cache)')
+    p.add_option('--db-refresh-limit', action='store', type='int', dest='db_refresh_limit', default=500, help='Maximum number of databases with outdated stats refreshed per check, the others are reported with their outdated stats')
     p.add_option('-s', '--ssl', dest='ssl', default=False, action='callback', callback=optional_arg(True), help='Connect using SSL')
     p.add_option('-r', '--replicaset', dest='replicaset', default=None, action='callback', callback=optional_arg(True), help='Connect to replicaset')
     p.add_option('-q', '--querytype', action='store', dest='query_type', default='query', help='The query type to check [query|insert|update|delete|getmore|command] from queries_per_second')
     p.add_option('-c', '--collection', action='store', dest='collection', default='admin', help='Specify the collection to check')
-    p.add_option('-T', '--time', action='store', type='int', dest='sample_time', default=1, help='Time used to sample number of pages faults')
+    p.add_option('--read-preference', action='store', type='choice', dest='read_preference', default=None, choices=READ_PREFERENCES,
+                 help='Replica set member to send the commands of the database and collection actions to: primary, primaryPreferred, secondary, secondaryPreferred or nearest (default: the server connected to)')
+    p.add_option('--max-staleness', action='store', type='int', dest='max_staleness', default=None, help='Seconds a secondary read with --read-preference may lag behind the primary at most (at least 90)')
+    p.add_option('--namespace', action='store', type='string', dest='namespace', default=None, help='Regular expression on database.collection: check all matching collections instead of -d/-c (collection_documents, collection_indexes, collection_size, collection_storageSize, chunks_balance)')
+    p.add_option('--row-count-mode', action='store', type='choice', dest='row_count_mode', default='estimated', choices=['estimated', 'exact'],
+                 help='row_count from the collection metadata (estimated, default) or by counting the documents (exact)')
+    p.add_option('--count-max-time', action='store', type='int', dest='count_max_time', default=10000, help='Milliseconds an exact row_count may take on the server')
+    p.add_option('--row-count-ttl', action='store', type='int', dest='row_count_ttl', default=3600, help='Seconds an exact row_count is reused by later checks')
+    p.add_option('--counters', action='store', type='string', dest='counters', default=None, help='Comma separated serverStatus counters (e.g. network.bytesIn, a trailing dot selects all counters below) for counter_rate')
+    p.add_option('-T', '--time', action='store', type='int', dest='sample_time', default=1, help='Ignored, page_faults compares to the previous run (see --samples)')
+    p.add_option('--samples', action='store', type='int', dest='samples', default=1, help='Number of serverStatus samples page_faults takes to report min/avg/max rates (default 1: rate since the previous run)')
+    p.add_option('--sample-interval', action='store', type='int', dest='sample_interval', default=100, help='Milliseconds between the samples of page_faults')
     p.add_option('-M', '--mongoversion', action='store', type='choice', dest='mongo_version', default='2', help='The MongoDB version you are talking with, either 2 or 3',
       choices=['2','3'])
     p.add_option('-a', '--authdb', action='store', type='string', dest='authdb', default='admin', help='The database you want to authenticate against')
@@ -168,33 +351,269 @@ def main(argv):
     p.add_option('-m','--auth-mechanism', action='store', type='choice', dest='auth_mechanism', default=None, help='Auth mechanism used for auth with mongodb',
     choices=['MONGODB-X509','SCRAM-SHA-256','SCRAM-SHA-1'])
     p.add_option('--disable_retry_writes', dest='retry_writes_disabled', default=False, action='callback', callback=optional_arg(True), help='Disable retryWrites feature')
+    p.add_option('--hosts', action='store', type='string', dest='hosts', default=None, help='Comma separated list of host[:port] to run the action(s) against concurrently')
+    p.add_option('--hosts-file', action='store', type='string', dest='hosts_file', default=None, help='File with one host[:port] per line to run the action(s) against concurrently')
+    p.add_option('--discover-members', action='store_true', dest='discover_members', default=False, help='Run the action(s) against all members of the replica set of --host')
+    p.add_option('--workers', action='store', type='int', dest='workers', default=10, help='Number of hosts checked at the same time (with --hosts, --hosts-file or --discover-members)')
+    p.add_option('--host-timeout', action='store', type='int', dest='host_timeout', default=30, help='Seconds after which a host is reported as UNKNOWN (with --hosts, --hosts-file or --discover-members)')
+    p.add_option('--broker-socket', action='store', type='string', dest='broker_socket', default=None, help='Unix socket of a connection broker to send commands through (falls back to connecting directly)')
+    p.add_option('--serve-broker', action='store_true', dest='serve_broker', default=False, help='Run as connection broker listening on --broker-socket')
+    p.add_option('--broker-idle-timeout', action='store', type='int', dest='broker_idle_timeout', default=300, help='Seconds after which the broker closes unused connections')
+    p.add_option('--timeout', action='store', type='float', dest='timeout', default=None, help='Seconds the whole check may take, connecting and every command get the remaining time (UNKNOWN when it runs out)')
+    p.add_option('--fast-connect', action='store_true', dest='fast_connect', default=False, help='Authenticate during the connection handshake and take the server version from it, skipping ping and buildInfo')
+    p.add_option('--compressors', action='store', type='string', dest='compressors', default=None,
+                 help='Comma separated wire protocol compressors to offer the server, in order of preference: zstd, snappy, zlib. Those the driver can not use are left out')
+    p.add_option('--timings', action='store_true', dest='timings', default=False, help='Add the time taken by the phases of the check (t_dns, t_connect, t_ismaster, t_auth, t_action_*), connection handshakes and each server command (t_cmd_*) to the performance data')
+    p.add_option('--timings-trace', action='store_true', dest='timings_trace', default=False, help='With --timings also write every timed event as JSON to stderr')
+    p.add_option('--round-trips', action='store_true', dest='round_trips', default=False, help='Add the number of server round trips and bytes sent/received to the performance data')
+    p.add_option('--metadata-ttl', action='store', type='int', dest='metadata_ttl', default=86400, help='Seconds buildInfo, hostInfo and the replica set configuration are reused by later checks unless the server restarts or the configuration changes (0 disables the cache)')
+    p.add_option('--status-cache-ttl', action='store', type='int', dest='status_cache_ttl', default=0, help='Share the serverStatus of a host with other checks running within this many seconds (0 disables the cache)')
+    return p
+
+
+def main(argv):
+    options, arguments = build_parser().parse_args(argv)
+
+    if options.serve_broker:
+        if not options.broker_socket:
+            return "--serve-broker needs --broker-socket"
+        return serve_broker(options.broker_socket, options.broker_idle_timeout)
+
+    err, actions = validate_options(options)
+    if err:
+        return err
 
-    options, arguments = p.parse_args()
+    result = run_checks(options, actions)
+    print(result.output)
+    return result.state
+
+
+def validate_options(options):
+    """ Return (error, actions): the (action, warning, critical) tuples to
+    check, or the message telling what is wrong with the options """
+    if options.actions:
+        specs = []
+        for part in options.actions.split(','):
+            part = part.strip()
+            if specs and re.match(r"-?[0-9.]", part):
+                # a further value of a comma list threshold (replset_state)
+                specs[-1] += ',' + part
+            else:
+                specs.append(part)
+        actions = []
+        for spec in specs:
+            spec = spec.split(':')
+            if spec[0] not in ACTIONS:
+                return "invalid action '%s' in --actions" % spec[0], None
+            actions.append((spec[0], (spec[1:2] or [options.warning])[0], (spec[2:3] or [options.critical])[0]))
+    elif options.action not in ACTIONS:
+        return "invalid action '%s'" % options.action, None
+    else:
+        actions = [(options.action, options.warning, options.critical)]
+
+    if options.workers < 1 or options.db_workers < 1:
+        return "--workers and --db-workers must be at least 1", None
+
+    for action, warning, critical in actions:
+        if action == 'replica_primary' and options.replicaset is None:
+            return "replicaset must be passed in when using replica_primary check", None
+        elif not action == 'replica_primary' and options.replicaset:
+            return "passing a replicaset while not checking replica_primary does not work", None
+
+    if options.max_staleness is not None:
+        if options.read_preference in (None, 'primary'):
+            return "--max-staleness needs a --read-preference reading from secondaries", None
+        if options.max_staleness < 90:
+            return "--max-staleness must be at least 90 seconds", None
+
+    if options.compressors:
+        names = options.compressors
+        if not isinstance(names, list):
+            names = [name.strip() for name in names.split(',') if name.strip()]
+        unknown = [name for name in names if name not in [compressor for compressor, module, version in COMPRESSORS]]
+        if unknown:
+            return "unknown compressor '%s' in --compressors" % unknown[0], None
+        options.compressors = available_compressors(names)
+
+    if options.round_trips:
+        count_round_trips()
+    return None, actions
+
+
+class CheckResult(object):
+    """ Result of a check: its Nagios state, the complete output as the
+    plugin prints it, the first line without performance data as message
+    and the performance data of the first line as a list of (value, label,
+    warning, critical) tuples of strings, missing thresholds are None.
+    With --timings trace holds the Trace of the check. """
+
+    def __init__(self, state, output, trace=None):
+        self.state = state
+        self.output = output
+        self.trace = trace
+        first_line = output.split('\n')[0]
+        self.message = first_line.split('|')[0].strip()
+        self.perfdata = []
+        if '|' in first_line:
+            for label, data in re.findall(r"('[^']*'|[^\s=|]+)=(\S+)", first_line.split('|', 1)[1]):
+                data = data.split(';') + [None, None]
+                self.perfdata.append((data[0], label, data[1] or None, data[2] or None))
+
+    def __repr__(self):
+        return "CheckResult(%r, %r)" % (self.state, self.output)
+
+
+def run_checks(options, actions, con=None):
+    """ Run the checks of validated options and return their CheckResult
+    instead of printing it or exiting. Checks run against con if given, it
+    is left open; otherwise against connections of their own, which are
+    closed afterwards unless this is the command line plugin exiting anyway. """
+    trace = None
+    if options.timings:
+        record_timings()
+        trace = traces.current = Trace()
+    try:
+        if options.hosts or options.hosts_file or options.discover_members:
+            state, output = capture_action(check_hosts, options, actions)
+        elif options.timeout:
+            state, output = capture_action(run_with_deadline, options.timeout, check, options, actions, con)
+        else:
+            state, output = capture_action(check, options, actions, con)
+    finally:
+        if trace is not None:
+            trace.leave()
+            traces.current = None
+
+    if trace is not None:
+        output = add_performance_data(output, trace.performance_data())
+        if options.timings_trace:
+            sys.stderr.write(trace.to_json(host=options.host, port=options.port, actions=[action for action, warning, critical in actions], state=state) + "\n")
+    return CheckResult(state, output, trace)
+
+
+def run_check(action='connect', con=None, **kwargs):
+    """ Run a check in-process, for programs keeping pymongo loaded and
+    connections open between checks, and return its CheckResult.
+
+    kwargs are the command line options by the names optparse stores them
+    under (host, port, warning, critical, database, perf_data, ...); the
+    others have their command line defaults. With con the check runs
+    against that open MongoClient instead of connecting to host:port. A
+    connection may only be used by one check at a time. """
+    global default_options
+    if default_options is None:
+        default_options = build_parser().get_default_values()
+    options = copy.copy(default_options)
+    options.action = action
+    for name, value in kwargs.items():
+        if not hasattr(default_options, name):
+            raise TypeError("run_check() got an unknown option '%s'" % name)
+        setattr(options, name, value)
+
+    err, actions = validate_options(options)
+    if err:
+        return CheckResult(3, "UNKNOWN - %s" % err)
+    options.close_connections = True
+    return run_checks(options, actions, con)
+
+
+# defaults of all options for run_check
+default_options = None
+
+
+def prepare_connection(con, host, port, options, actions):
+    """ Set up the per connection state of a run of actions on con """
+    if options.metadata_ttl > 0:
+        metadata_caches[id(con)] = (host, port, options.metadata_ttl)
+    if options.status_cache_ttl > 0:
+        enable_server_status_cache(con, host, port, options.status_cache_ttl)
+    if options.read_preference:
+        read_preferences[id(con)] = make_read_preference(options.read_preference, options.max_staleness)
+    server_status_sections[id(con)] = needed_server_status_sections([action for action, warning, critical in actions], options)
+    # all actions of this run share one serverStatus document
+    server_status_snapshots[id(con)] = None
+
+
+def forget_connection(con):
+    """ Drop the per connection state of con once its actions ran """
+    if connect_arguments.get(id(con), {}).get('compressors'):
+        for address in con.nodes:
+            negotiated_compressors.pop(address, None)
+    for per_connection in (metadata_caches, server_status_caches, server_status_sections, server_status_snapshots,
+                           metadata_documents, ismaster_replies, server_versions, collection_stats, read_preferences, connect_arguments):
+        per_connection.pop(id(con), None)
+    if id(con) in read_clients:
+        read_clients.pop(id(con)).close()
+
+
+def check(options, actions, con=None):
+    """ Connect to --host, or take con, and run the actions against it """
     host = options.host
+    port = options.port
     host_to_check = options.host_to_check if options.host_to_check else options.host
+    if (options.rdns_lookup):
+      enter_phase("reverse DNS lookup of %s" % host_to_check, "rdns")
+      host_to_check = resolve_rdns([host_to_check], options.rdns_cache_ttl)[host_to_check]
+    port_to_check = options.port_to_check if options.port_to_check else options.port
+
+    #
+    # moving the login up here and passing in the connection
+    #
+    start = time.time()
+    before = round_trips.snapshot()
+    opened = con is None
+    if opened:
+        err, con = connect(options, host, port, actions)
+        if err != 0:
+            return err
+
+    prepare_connection(con, host, port, options, actions)
+    try:
+        # Autodetect mongo-version and force pymongo to let us know if it can connect or not.
+        enter_phase("server version detection", "version")
+        err, mongo_version = check_version(con)
+        if err != 0:
+            return err
+
+        conn_time = time.time() - start
+
+        if options.actions:
+            return check_multiple_actions(con, actions, options, host_to_check, port_to_check, mongo_version, conn_time, before)
+
+        if options.round_trips:
+            state, output = capture_action(run_action, con, options.action, options, options.warning, options.critical, host_to_check, port_to_check, mongo_version, conn_time)
+            print(add_performance_data(output, round_trips.performance_data(before, wire_size_known(con, options))))
+            return state
+
+        return run_action(con, options.action, options, options.warning, options.critical, host_to_check, port_to_check, mongo_version, conn_time)
+    finally:
+        forget_connection(con)
+        if opened and getattr(options, 'close_connections', False):
+            if current_trace() is not None:
+                current_trace().enter("close")
+            con.close()
+
+
+def run_action(con, action, options, warning, critical, host_to_check, port_to_check, mongo_version, conn_time):
+    host = options.host
     rdns_lookup = options.rdns_lookup
-    if (rdns_lookup):
-      host_to_check = socket.getnameinfo((host_to_check, 0), 0)[0]
     port = options.port
-    port_to_check = options.port_to_check if options.port_to_check else options.port
     user = options.user
     passwd = options.passwd
     authdb = options.authdb
 
     query_type = options.query_type
     collection = options.collection
-    sample_time = options.sample_time
-    if (options.action == 'replset_state'):
-        warning = str(options.warning or "")
-        critical = str(options.critical or "")
+    if (action == 'replset_state'):
+        warning = str(warning or "")
+        critical = str(critical or "")
     else:
-        warning = float(options.warning or 0)
-        critical = float(options.critical or 0)
+        warning = float(warning or 0)
+        critical = float(critical or 0)
 
-    action = options.action
+    enter_phase("%s action" % action, "action_" + action)
     perf_data = options.perf_data
     max_lag = options.max_lag
-    mongo_version = options.mongo_version
     database = options.database
     ssl = options.ssl
     replicaset = options.replicaset
@@ -204,34 +623,16 @@ def main(argv):
     auth_mechanism = options.auth_mechanism
     retry_writes_disabled = options.retry_writes_disabled
 
-    if action == 'replica_primary' and replicaset is None:
-        return "replicaset must be passed in when using replica_primary check"
-    elif not action == 'replica_primary' and replicaset:
-        return "passing a replicaset while not checking replica_primary does not work"
-
-    #
-    # moving the login up here and passing in the connection
-    #
-    start = time.time()
-    err, con = mongo_connect(host, port, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
-    if err != 0:
-        return err
-
-    # Autodetect mongo-version and force pymongo to let us know if it can connect or not.
-    err, mongo_version = check_version(con)
-    if err != 0:
-        return err
-
-    conn_time = time.time() - start
-
     if action == "connections":
         return check_connections(con, warning, critical, perf_data)
     elif action == "replication_lag":
-        return check_rep_lag(con, host_to_check, port_to_check, rdns_lookup, warning, critical, False, perf_data, max_lag, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+        return check_rep_lag(con, host_to_check, port_to_check, rdns_lookup, warning, critical, False, perf_data, max_lag, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled, rdns_cache_ttl=options.rdns_cache_ttl, oplog_window_ttl=options.oplog_window_ttl, compressors=options.compressors)
     elif action == "replication_lag_percent":
-        return check_rep_lag(con, host_to_check, port_to_check, rdns_lookup, warning, critical, True, perf_data, max_lag, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+        return check_rep_lag(con, host_to_check, port_to_check, rdns_lookup, warning, critical, True, perf_data, max_lag, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled, rdns_cache_ttl=options.rdns_cache_ttl, oplog_window_ttl=options.oplog_window_ttl, compressors=options.compressors)
     elif action == "replset_state":
         return check_replset_state(con, perf_data, warning, critical)
+    elif action == "replset_members":
+        return check_replset_members(con, warning, critical, perf_data, options.passive_command_file, options.passive_service)
     elif action == "memory":
         return check_memory(con, warning, critical, perf_data, options.mapped_memory, host)
     elif action == "memory_mapped":
@@ -251,18 +652,22 @@ def main(argv):
     elif action == "databases":
         return check_databases(con, warning, critical, perf_data)
     elif action == "collections":
-        return check_collections(con, warning, critical, perf_data)
+        return check_collections(con, host, port, warning, critical, perf_data, options.db_stats_ttl, options.db_refresh_limit, options.db_workers)
     elif action == "oplog":
-        return check_oplog(con, warning, critical, perf_data)
+        return check_oplog(con, host, port, warning, critical, perf_data, options.oplog_window_ttl)
+    elif action == "oplog_throughput":
+        return check_oplog_throughput(con, host, port, warning, critical, perf_data, options.top, options.oplog_window_ttl)
     elif action == "journal_commits_in_wl":
         return check_journal_commits_in_wl(con, warning, critical, perf_data)
     elif action == "database_size":
         if options.all_databases:
-            return check_all_databases_size(con, warning, critical, perf_data)
+            return check_all_databases_size(con, host, port, warning, critical, perf_data, options.top, options.db_stats_ttl, options.db_refresh_limit, options.db_workers)
         else:
             return check_database_size(con, database, warning, critical, perf_data)
     elif action == "database_indexes":
         return check_database_indexes(con, database, warning, critical, perf_data)
+    elif action in COLLECTION_METRICS and options.namespace:
+        return check_collections_matching(con, action, options.namespace, warning, critical, perf_data, options.top, options.db_workers)
     elif action == "collection_documents":
         return check_collection_documents(con, database, collection, warning, critical, perf_data)
     elif action == "collection_indexes":
@@ -280,27 +685,332 @@ def main(argv):
     elif action == "asserts":
         return check_asserts(con, host, port, warning, critical, perf_data)
     elif action == "replica_primary":
-        return check_replica_primary(con, host, warning, critical, perf_data, replicaset, mongo_version)
+        return check_replica_primary(con, host, port, warning, critical, perf_data, replicaset)
     elif action == "queries_per_second":
-        return check_queries_per_second(con, query_type, warning, critical, perf_data, mongo_version)
+        return check_queries_per_second(con, host, port, query_type, warning, critical, perf_data)
     elif action == "page_faults":
-        check_page_faults(con, sample_time, warning, critical, perf_data)
+        return check_page_faults(con, host, port, warning, critical, perf_data, options.samples, options.sample_interval)
     elif action == "chunks_balance":
-        chunks_balance(con, database, collection, warning, critical)
+        if not options.namespace and (database, collection) != ('admin', 'admin'):
+            # a single collection given with -d and -c
+            return chunks_balance(con, '^%s$' % re.escape(database + "." + collection), warning, critical, perf_data, options.top)
+        return chunks_balance(con, options.namespace, warning, critical, perf_data, options.top)
     elif action == "connect_primary":
         return check_connect_primary(con, warning, critical, perf_data)
     elif action == "collection_state":
         return check_collection_state(con, database, collection)
     elif action == "row_count":
-        return check_row_count(con, database, collection, warning, critical, perf_data)
+        return check_row_count(con, host, port, database, collection, warning, critical, perf_data, options.row_count_mode, options.count_max_time, options.row_count_ttl)
     elif action == "replset_quorum":
         return check_replset_quorum(con, perf_data)
+    elif action == "counter_rate":
+        return check_counter_rate(con, host, port, options.counters, warning, critical, perf_data)
     else:
         return check_connect(host, port, warning, critical, perf_data, user, passwd, conn_time)
 
 
-def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, replica=None, authdb="admin", insecure=False, ssl_ca_cert_file=None, ssl_cert=None, auth_mechanism=None, retry_writes_disabled=False):
+
+
+def connect(options, host, port, actions):
+    """ Connect to host:port through the broker if possible, directly otherwise """
+    con = None
+    if options.broker_socket and all(action in BROKER_ACTIONS for action, warning, critical in actions) and not options.namespace \
+            and not options.read_preference:
+        con = broker_connect(options.broker_socket, dict(host=host, port=port, ssl=options.ssl, user=options.user, passwd=options.passwd, replica=options.replicaset,
+                                                         authdb=options.authdb, insecure=options.insecure, ssl_ca_cert_file=options.ssl_ca_cert_file,
+                                                         ssl_cert=options.cert_file, auth_mechanism=options.auth_mechanism, retry_writes_disabled=options.retry_writes_disabled,
+                                                         compressors=options.compressors))
+    if con is None:
+        err, con = mongo_connect(host, port, options.ssl, options.user, options.passwd, options.replicaset, options.authdb, options.insecure,
+                                 options.ssl_ca_cert_file, options.cert_file, options.auth_mechanism, retry_writes_disabled=options.retry_writes_disabled,
+                                 fast_connect=options.fast_connect, compressors=options.compressors)
+        if err != 0:
+            return err, None
+    return 0, con
+
+
+def run_actions(con, actions, options, host_to_check, port_to_check, mongo_version, conn_time):
+    """ Run several actions against one connection. Returns a list of
+    (action, state, output). """
+    results = []
+    for action, warning, critical in actions:
+        before = round_trips.snapshot()
+        state, output = capture_action(run_action, con, action, options, warning, critical, host_to_check, port_to_check, mongo_version, conn_time)
+        if options.round_trips:
+            output = add_performance_data(output, round_trips.performance_data(before, wire_size_known(con, options)))
+        results.append((action, state, output))
+    return results
+
+
+def check_multiple_actions(con, actions, options, host_to_check, port_to_check, mongo_version, conn_time, since=(0, 0, 0, 0, 0)):
+    """ Run several actions against one connection and print one result line per action. """
+    results = run_actions(con, actions, options, host_to_check, port_to_check, mongo_version, conn_time)
+
+    worst_state = max([r[1] for r in results], key=STATE_SEVERITY.index)
+    counts = [len([r for r in results if r[1] == state]) for state in (2, 1, 3)]
+    summary = "%s - %i actions checked, %i critical, %i warning, %i unknown" % ((state_name(worst_state), len(results)) + tuple(counts))
+    if options.round_trips:
+        summary = add_performance_data(summary, round_trips.performance_data(since, wire_size_known(con, options)))
+    print(summary)
+    for action, state, output in results:
+        print("%s: %s" % (action, output))
+    return worst_state
+
+
+def check_hosts(options, actions):
+    """ Run the actions against many hosts concurrently and print one
+    host:port;action;state;output line per host and action. """
+    hosts = []
+    if options.hosts:
+        hosts += options.hosts.split(',')
+    if options.hosts_file:
+        f = open(options.hosts_file)
+        hosts += [line.split('#')[0] for line in f]
+        f.close()
+    if options.discover_members:
+        err, hosts_discovered = discover_members(options)
+        if err != 0:
+            return err
+        hosts += hosts_discovered
+
+    targets = []
+    for host in hosts:
+        host, port = split_host_port(host.strip())
+        if host and (host, port or options.port) not in targets:
+            targets.append((host, port or options.port))
+    if not targets:
+        return "no hosts to check"
+
+    results = run_concurrently(lambda target: check_host(options, target[0], target[1], actions), targets, options.workers, options.host_timeout)
+
+    lines = []
+    host_states = []
+    for (host, port), host_results in zip(targets, results):
+        if isinstance(host_results, WorkerTimeout):
+            host_results = [(action, 3, "UNKNOWN - No result within %i seconds" % options.host_timeout) for action, warning, critical in actions]
+        elif isinstance(host_results, BaseException):
+            host_results = [(action, 3, "UNKNOWN - %s" % host_results) for action, warning, critical in actions]
+        for action, state, output in host_results:
+            lines.append((host, port, action, state, output))
+        host_states.append(max([result[1] for result in host_results], key=STATE_SEVERITY.index))
+
+    # hosts are counted by the worst state of their actions
+    worst_state = max(host_states, key=STATE_SEVERITY.index)
+    counts = [host_states.count(state) for state in (2, 1, 3)]
+    print("%s - %i hosts checked, %i critical, %i warning, %i unknown" % ((state_name(worst_state), len(targets)) + tuple(counts)))
+    for host, port, action, state, output in lines:
+        print("%s:%s;%s;%i;%s" % (host, port, action, state, " ".join(output.splitlines())))
+    return worst_state
+
+
+def check_host(options, host, port, actions):
+    """ Connect to one host and run all actions against it, reporting a
+    connection problem as the result of every action. """
+    host_options = copy.copy(options)
+    host_options.host = host
+    host_options.port = port
+    results = []
+
+    def connect_and_run():
+        start = time.time()
+        err, con = connect(host_options, host, port, actions)
+        if err != 0:
+            return err
+        prepare_connection(con, host, port, options, actions)
+        try:
+            enter_phase("server version detection", "version")
+            err, mongo_version = check_version(con)
+            if err != 0:
+                return err
+            results.extend(run_actions(con, actions, host_options, host, port, mongo_version, time.time() - start))
+        finally:
+            forget_connection(con)
+            con.close()
+        return 0
+
+    if options.timeout:
+        state, output = capture_action(run_with_deadline, options.timeout, connect_and_run)
+    else:
+        state, output = capture_action(connect_and_run)
+    return results or [(action, state, output) for action, warning, critical in actions]
+
+
+def discover_members(options):
+    """ Return the members of the replica set the seed host belongs to """
+    err, con = connect(options, options.host, options.port, [])
+    if err != 0:
+        return err, None
+    try:
+        try:
+            config = con.admin.command("replSetGetConfig")['config']
+        except pymongo.errors.OperationFailure:
+            config = con.local.system.replset.find_one()
+        if config is None:
+            return "UNKNOWN - %s:%s is not a replica set member" % (options.host, options.port), None
+        return 0, [member['host'] for member in config['members']]
+    except Exception as e:
+        return exit_with_general_critical(e), None
+    finally:
+        con.close()
+
+
+class WorkerTimeout(Exception):
+    pass
+
+
+def run_concurrently(func, items, workers, timeout=None):
+    """ Call func for every item using at most workers threads and return the
+    results in the order of items. Exceptions are returned instead of raised,
+    a call still running timeout seconds after it started is abandoned and
+    returns WorkerTimeout. """
+    results = {}
+    started = {}
+    todo = list(enumerate(items))
+    todo.reverse()
+    todo_lock = threading.Lock()
+    trace = current_trace()
+    parent_phase = trace and trace.current_phase()
+
+    def worker():
+        traces.current = trace
+        traces.parent_phase = parent_phase
+        while True:
+            with todo_lock:
+                if not todo:
+                    return
+                index, item = todo.pop()
+                started[index] = time.time()
+            try:
+                result = func(item)
+            except BaseException as e:
+                result = e
+            if trace is not None:
+                trace.leave()
+            with done:
+                results.setdefault(index, result)
+                done.notify()
+
+    def start_worker():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    done = threading.Condition()
+    for i in range(min(max(workers, 1), len(items))):
+        start_worker()
+
+    with done:
+        while len(results) < len(items):
+            if timeout is None:
+                done.wait()
+                continue
+            now = time.time()
+            wait = timeout
+            for index, start in list(started.items()):
+                if index in results:
+                    continue
+                if now - start > timeout:
+                    results[index] = WorkerTimeout()
+                    # the hung thread keeps its slot, give the remaining items a new one
+                    start_worker()
+                else:
+                    wait = min(wait, start + timeout - now)
+            if len(results) < len(items):
+                done.wait(max(wait, 0.01))
+    return [results[index] for index in range(len(items))]
+
+
+def map_concurrently(func, items, workers):
+    """ run_concurrently within the --timeout budget of the calling thread:
+    once it is spent the remaining items fail with DeadlineExceeded. """
+    deadline = current_deadline()
+
+    def call(item):
+        if deadline is not None:
+            # the workers do not see the deadline of this thread
+            deadline.remaining()
+        return func(item)
+
+    return run_concurrently(call, items, workers, deadline and deadline.remaining())
+
+
+#
+# Output of the checks run by capture_action is collected per thread, so
+# that checks can run concurrently.
+#
+captured_output = threading.local()
+
+
+class CapturedOutput(object):
+    """ sys.stdout replacement writing into the capture buffer of the current thread """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, data):
+        (getattr(captured_output, 'buffer', None) or self.stdout).write(data)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        # buffer, fileno, isatty, encoding, ... of the real stdout
+        return getattr(self.stdout, name)
+
+
+# captures running in any thread, sys.stdout is restored when the last ends
+captures = {'running': 0}
+captures_lock = threading.Lock()
+
+
+def capture_action(func, *args):
+    """ Call an action function and return its Nagios state and printed output
+    instead of letting it write to stdout or exit the process. """
+    with captures_lock:
+        if not isinstance(sys.stdout, CapturedOutput):
+            sys.stdout = CapturedOutput(sys.stdout)
+        captures['running'] += 1
+    outer_buffer = getattr(captured_output, 'buffer', None)
+    captured_output.buffer = StringIO()
+    try:
+        try:
+            state = func(*args)
+        except SystemExit as e:
+            state = e.code
+        except Exception as e:
+            # one failing action must not take the others down
+            state = exit_with_general_critical(e)
+    finally:
+        output = captured_output.buffer.getvalue().strip()
+        captured_output.buffer = outer_buffer
+        with captures_lock:
+            captures['running'] -= 1
+            if not captures['running'] and isinstance(sys.stdout, CapturedOutput):
+                sys.stdout = sys.stdout.stdout
+
+    if isinstance(state, SystemExit):
+        state = state.code
+    if state is None:
+        state = 0
+    elif not isinstance(state, int):
+        output = output or str(state)
+        state = 1 if state else 0
+    if not output:
+        output = "%s - no output" % state_name(state)
+    return state, output
+
+
+# Nagios states ordered from best to worst
+STATE_SEVERITY = [0, 3, 1, 2]
+
+
+def state_name(state):
+    return {0: "OK", 1: "WARNING", 2: "CRITICAL"}.get(state, "UNKNOWN")
+
+
+def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, replica=None, authdb="admin", insecure=False, ssl_ca_cert_file=None, ssl_cert=None, auth_mechanism=None, retry_writes_disabled=False, fast_connect=False, compressors=None):
     from pymongo.errors import ConnectionFailure
+    from pymongo.errors import OperationFailure
     from pymongo.errors import PyMongoError
     import ssl as SSL
 
@@ -320,6 +1030,37 @@ def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, repli
     if retry_writes_disabled:
         con_args['retryWrites'] = False
 
+    if compressors:
+        # the server picks the first one it supports, or none
+        con_args['compressors'] = ','.join(compressors)
+
+    if current_trace() is not None:
+        # the driver resolves the name again, but usually from a cache then
+        enter_phase("name lookup of %s" % host, "dns")
+        try:
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.error:
+            pass
+
+    enter_phase("connect to %s:%s" % (host, port), "connect")
+    deadline = current_deadline()
+    if deadline is not None:
+        con_args['serverSelectionTimeoutMS'] = con_args['connectTimeoutMS'] = con_args['socketTimeoutMS'] = deadline.remaining_ms()
+
+    # let the driver authenticate while establishing the connection (speculative
+    # authentication with MongoDB 4.4+) instead of separate authenticate round trips
+    auth_args = dict()
+    if user and pymongo.version_tuple >= (3, 5):
+        auth_args['username'] = user
+        if passwd:
+            auth_args['password'] = passwd
+        auth_args['authSource'] = '$external' if auth_mechanism == 'MONGODB-X509' else authdb
+        if auth_mechanism:
+            auth_args['authMechanism'] = auth_mechanism
+    handshake_auth = fast_connect and auth_args
+    if handshake_auth:
+        con_args.update(auth_args)
+
     try:
         # ssl connection for pymongo > 2.3
         if pymongo.version >= "2.3":
@@ -334,7 +1075,11 @@ def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, repli
                 con = pymongo.Connection(host, port, slave_okay=True, network_timeout=10)
 
         # we must authenticate the connection, otherwise we won't be able to perform certain operations
-        if ssl_cert and ssl_ca_cert_file and user and auth_mechanism == 'SCRAM-SHA-256':
+        if not handshake_auth and ssl_cert and ssl_ca_cert_file and user:
+            enter_phase("authentication to %s:%s" % (host, port), "auth")
+        if handshake_auth:
+            pass
+        elif ssl_cert and ssl_ca_cert_file and user and auth_mechanism == 'SCRAM-SHA-256':
             con.the_database.authenticate(user, mechanism='SCRAM-SHA-256')
         elif ssl_cert and ssl_ca_cert_file and user and auth_mechanism == 'SCRAM-SHA-1':
             con.the_database.authenticate(user, mechanism='SCRAM-SHA-1')
@@ -342,24 +1087,44 @@ def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, repli
             con.the_database.authenticate(user, mechanism='MONGODB-X509')
 
         try:
-          result = con.admin.command("ismaster")
-        except ConnectionFailure:
+          enter_phase("connect to %s:%s" % (host, port), "ismaster")
+          if compressors:
+              # the server answers with the compressors it agreed to use on the connection
+              result = con.admin.command(son.SON([("ismaster", 1), ("compression", compressors)]))
+              negotiated_compressors[con.address] = (result.get('compression') or [None])[0]
+          else:
+              result = con.admin.command("ismaster")
+        except ConnectionFailure as e:
+          if is_timeout(e) and not connection_refused(con):
+              raise
           print("CRITICAL - Connection to Mongo server on %s:%s has failed" % (host, port) )
           sys.exit(2)
+        except OperationFailure as e:
+          if handshake_auth and e.code == 18:
+              sys.exit("Username/Password incorrect")
+          raise
 
         if 'arbiterOnly' in result and result['arbiterOnly'] == True:
             print("OK - State: 7 (Arbiter on port %s)" % (port))
             sys.exit(0)
 
-        if user and passwd:
+        if user and passwd and not handshake_auth:
+            enter_phase("authentication to %s:%s" % (host, port), "auth")
             db = con[authdb]
             try:
               db.authenticate(user, password=passwd)
             except PyMongoError:
                 sys.exit("Username/Password incorrect")
 
-        # Ping to check that the server is responding.
-        con.admin.command("ping")
+        ismaster_replies[id(con)] = result
+        connect_arguments[id(con)] = dict(con_args, **auth_args)
+        if fast_connect:
+            # ismaster already proved the server answers, and tells its version
+            server_versions[id(con)] = wire_server_version(result)
+        else:
+            # Ping to check that the server is responding.
+            enter_phase("ping of %s:%s" % (host, port), "ping")
+            con.admin.command("ping")
 
     except Exception as e:
         if isinstance(e, pymongo.errors.AutoReconnect) and str(e).find(" is an arbiter") != -1:
@@ -371,34 +1136,783 @@ def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, repli
     return 0, con
 
 
+def server_errors(con):
+    """ Errors the driver got connecting to the servers of con (pymongo 3.7+) """
+    description = getattr(con, 'topology_description', None)
+    if description is None:
+        return []
+    return [server.error for server in description.server_descriptions().values() if server.error]
+
+
+def connection_refused(con):
+    """ Tell whether the driver failed to reach the servers of con for another
+    reason than running out of time, e.g. the connection being refused """
+    for error in server_errors(con):
+        if not isinstance(error, pymongo.errors.NetworkTimeout) and 'timed out' not in str(error):
+            return True
+    return False
+
+
 def exit_with_general_warning(e):
     if isinstance(e, SystemExit):
         return e
+    elif is_timeout(e):
+        return exit_with_timeout()
     else:
         print("WARNING - General MongoDB warning:", e)
     return 1
 
 
+def exit_first_run():
+    """ Rate actions have nothing to report until a previous sample is stored,
+    which must not alert after an upgrade or when adding the action """
+    print("OK - First run of check, no previous values stored yet, rates are available from the next run on")
+    return 0
+
+
 def exit_with_general_critical(e):
     if isinstance(e, SystemExit):
         return e
+    elif is_timeout(e):
+        return exit_with_timeout()
     else:
         print("CRITICAL - General MongoDB Error:", e)
     return 2
 
 
-def set_read_preference(db):
-    if pymongo.version >= "2.2":
-        pymongo.read_preferences.Secondary
+#
+# Time budget (--timeout) of the check running in the current thread
+#
+deadlines = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    """ Time budget of a check and the phase the check is in """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        # server calls give up early, the driver overshoots server selection
+        # timeouts by up to half a second (its minimum heartbeat interval)
+        self.expires = time.time() + seconds - min(seconds / 2.0, 1.0)
+        self.phase = "startup"
+
+    def remaining(self):
+        remaining = self.expires - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return remaining
+
+    def remaining_ms(self):
+        return max(int(self.remaining() * 1000), 1)
+
+
+def current_deadline():
+    return getattr(deadlines, 'current', None)
+
+
+def enter_phase(phase, label=None):
+    """ Record the phase of the check, giving up if the budget is already
+    spent. With --timings the time of the phase is taken under label. """
+    trace = current_trace()
+    if trace is not None and label:
+        trace.enter(label)
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.phase = phase
+        deadline.remaining()
+
+
+#
+# --timings: the time the phases of a check (entered with enter_phase), the
+# server commands and the connection handshakes took. The trace of a check
+# is kept per thread, run_concurrently hands it on to its workers.
+#
+traces = threading.local()
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def current_trace():
+    return getattr(traces, 'current', None)
+
+
+class Trace(object):
+    """ Timings of one check as (kind, name, phase, start, seconds) events,
+    start counted from the start of the check """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = clock()
+        self.events = []
+        self.connections = {}
+
+    def add(self, kind, name, start, seconds, phase=None):
+        with self.lock:
+            self.events.append((kind, name, phase, start - self.start, seconds))
+
+    def current_phase(self):
+        phase = getattr(traces, 'phase', None)
+        return phase[0] if phase else getattr(traces, 'parent_phase', None)
+
+    def enter(self, label):
+        """ End the phase the current thread is in and start the next one """
+        now = clock()
+        self.leave(now)
+        traces.phase = (label, now)
+
+    def leave(self, now=None):
+        phase = getattr(traces, 'phase', None)
+        if phase is not None:
+            self.add('phase', phase[0], phase[1], (now or clock()) - phase[1])
+            traces.phase = None
+
+    def totals(self, kind):
+        totals = {}
+        for event_kind, name, phase, start, seconds in self.events:
+            if event_kind == kind:
+                totals[name] = totals.get(name, 0) + seconds
+        return totals
+
+    def performance_data(self):
+        """ Total, phases, handshakes and commands summed up by name, and the
+        time of the actions not spent waiting for commands """
+        total = clock() - self.start
+        phases = self.totals('phase')
+        commands = self.totals('cmd')
+        handshakes = self.totals('handshake')
+        action_time = sum(seconds for name, seconds in phases.items() if name.startswith('action_'))
+        action_commands = sum(event[4] for event in self.events if event[0] == 'cmd' and (event[2] or '').startswith('action_'))
+        data = [("%.3fms" % (total * 1000), "t_total")]
+        data += [("%.3fms" % (seconds * 1000), "t_" + name) for name, seconds in sorted(phases.items())]
+        if handshakes:
+            data.append(("%.3fms" % (sum(handshakes.values()) * 1000), "t_handshake"))
+        data += [("%.3fms" % (seconds * 1000), "t_cmd_" + name) for name, seconds in sorted(commands.items())]
+        if action_time:
+            data.append(("%.3fms" % (max(action_time - action_commands, 0) * 1000), "t_python"))
+        return data
+
+    def to_json(self, **fields):
+        import json
+        fields['events'] = [dict(kind=kind, name=name, phase=phase, start=round(start, 6), seconds=round(seconds, 6))
+                            for kind, name, phase, start, seconds in self.events]
+        return json.dumps(fields, sort_keys=True)
+
+
+def record_timings():
+    """ Register driver event listeners feeding the trace of the current thread """
+    if getattr(record_timings, 'registered', False):
+        return
+    from pymongo import monitoring
+
+    class CommandTimer(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            trace = current_trace()
+            if trace is not None:
+                seconds = event.duration_micros / 1e6
+                trace.add('cmd', event.command_name, clock() - seconds, seconds, trace.current_phase())
+
+        failed = succeeded
+
+    class HandshakeTimer(monitoring.ConnectionPoolListener):
+        """ Time from creating a connection (TCP, TLS) to its handshake (and
+        authentication) being done """
+
+        def connection_created(self, event):
+            trace = current_trace()
+            if trace is not None:
+                trace.connections[(event.address, event.connection_id)] = clock()
+
+        def connection_ready(self, event):
+            trace = current_trace()
+            if trace is not None and (event.address, event.connection_id) in trace.connections:
+                start = trace.connections.pop((event.address, event.connection_id))
+                trace.add('handshake', "%s:%s" % event.address, start, clock() - start, trace.current_phase())
+
+        def ignore(self, event):
+            pass
+
+        pool_created = pool_ready = pool_cleared = pool_closed = ignore
+        connection_closed = ignore
+        connection_check_out_started = connection_check_out_failed = ignore
+        connection_checked_out = connection_checked_in = ignore
+
+    monitoring.register(CommandTimer())
+    if hasattr(monitoring, 'ConnectionPoolListener'):
+        monitoring.register(HandshakeTimer())
+    record_timings.registered = True
+
+
+def is_timeout(e):
+    """ Tell whether e is caused by running out of the --timeout budget """
+    if current_deadline() is None:
+        return False
+    if isinstance(e, (DeadlineExceeded, WorkerTimeout)) or getattr(e, 'timeout', False):
+        return True
+    if isinstance(e, pymongo.errors.OperationFailure) and e.code == 50:
+        # MaxTimeMSExpired
+        return True
+    return isinstance(e, (pymongo.errors.ExecutionTimeout, pymongo.errors.NetworkTimeout, pymongo.errors.ServerSelectionTimeoutError))
+
+
+def exit_with_timeout():
+    deadline = current_deadline()
+    print("UNKNOWN - Check did not finish within %ss, timed out during %s" % (deadline.seconds, deadline.phase))
+    return 3
+
+
+def run_with_deadline(seconds, func, *args):
+    """ Call func with a budget of seconds. With pymongo 4.2+ every operation
+    gets the remaining time as socket timeout and maxTimeMS, older versions
+    get it as connection timeouts from mongo_connect. In the main thread an
+    alarm also interrupts anything else (like DNS lookups) still running when
+    the budget is spent. """
+    deadlines.current = Deadline(seconds)
+    alarm = hasattr(signal, 'setitimer') and isinstance(threading.current_thread(), threading._MainThread)
+    if alarm:
+        def expired(signum, frame):
+            raise DeadlineExceeded()
+        previous_handler = signal.signal(signal.SIGALRM, expired)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        try:
+            if hasattr(pymongo, 'timeout'):
+                with pymongo.timeout(deadlines.current.remaining()):
+                    return func(*args)
+            return func(*args)
+        except Exception as e:
+            if is_timeout(e):
+                return exit_with_timeout()
+            raise
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+        deadlines.current = None
+
+
+#
+# Read preference of the commands of the stats actions (--read-preference),
+# keyed by connection. Commands that can not be sent to the server of the
+# connection go through a client of its replica set, opened on first use
+# with the arguments the connection was opened with.
+#
+read_preferences = {}
+connect_arguments = {}
+read_clients = {}
+read_clients_lock = threading.Lock()
+
+READ_PREFERENCES = ['primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest']
+
+
+def make_read_preference(mode, max_staleness=None):
+    from pymongo import read_preferences
+    if mode == 'primary':
+        return read_preferences.Primary()
+    cls = getattr(read_preferences, mode[0].upper() + mode[1:])
+    return cls(max_staleness=max_staleness or -1)
+
+
+class ReadDatabase(object):
+    """ Stand-in for a Database that runs its commands with a read preference,
+    Database.command() would always read from the primary """
+
+    def __init__(self, database, read_preference):
+        self.database = database
+        self.read_preference = read_preference
+
+    def __getitem__(self, name):
+        return self.database[name]
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def command(self, *args, **kwargs):
+        kwargs.setdefault('read_preference', self.read_preference)
+        return self.database.command(*args, **kwargs)
+
+
+def read_client(con):
+    """ Client of the replica set of the server of con """
+    with read_clients_lock:
+        if id(con) not in read_clients:
+            ismaster = get_ismaster(con)
+            seeds = ismaster.get('hosts', []) + ismaster.get('passives', [])
+            read_clients[id(con)] = pymongo.MongoClient(seeds, replicaSet=ismaster['setName'], read_preference=read_preferences[id(con)],
+                                                        **connect_arguments.get(id(con), {}))
+        return read_clients[id(con)]
+
+
+def read_database(con, name):
+    """ Database name for the commands of the stats actions: on the server of
+    con if it fits the --read-preference, on a member of its replica set
+    that does otherwise. A mongos gets the read preference passed on. """
+    read_preference = read_preferences.get(id(con))
+    if read_preference is None:
+        return con[name]
+    ismaster = get_ismaster(con)
+    if ismaster.get('msg') == 'isdbgrid':
+        client = con
+    elif 'setName' not in ismaster:
+        # nothing else to read from
+        return con[name]
+    elif read_preference.mongos_mode in ('primary', 'primaryPreferred') and ismaster.get('ismaster'):
+        return con[name]
+    elif read_preference.mongos_mode in ('secondary', 'secondaryPreferred') and ismaster.get('secondary') and read_preference.max_staleness == -1:
+        return con[name]
+    else:
+        client = read_client(con)
+    return ReadDatabase(client.get_database(name, read_preference=read_preference), read_preference)
+
+
+class RoundTripCounter(object):
+    """ Counts the round trips to the servers (commands, connection handshakes
+    and monitoring heartbeats) and the size of commands and replies, as BSON
+    and as sent over the wire with --compressors """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.wire_bytes_sent = 0
+        self.wire_bytes_received = 0
+
+    def add(self, round_trips, bytes_sent=0, bytes_received=0, wire_bytes_sent=0, wire_bytes_received=0):
+        with self.lock:
+            self.round_trips += round_trips
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            self.wire_bytes_sent += wire_bytes_sent
+            self.wire_bytes_received += wire_bytes_received
+
+    def snapshot(self):
+        return (self.round_trips, self.bytes_sent, self.bytes_received, self.wire_bytes_sent, self.wire_bytes_received)
+
+    def performance_data(self, since=(0, 0, 0, 0, 0), compressed=False):
+        """ Perf data of the round trips since the snapshot since, with
+        compressed (--compressors given) also the size on the wire """
+        round_trips, bytes_sent, bytes_received, wire_bytes_sent, wire_bytes_received = [now - then for now, then in zip(self.snapshot(), since)]
+        data = [(round_trips, "round_trips"), ("%iB" % bytes_sent, "bytes_sent"), ("%iB" % bytes_received, "bytes_received")]
+        if compressed:
+            data += [("%iB" % wire_bytes_sent, "wire_bytes_sent"), ("%iB" % wire_bytes_received, "wire_bytes_received")]
+        return data
+
+
+round_trips = RoundTripCounter()
+
+
+def wire_size_known(con, options):
+    """ The wire size is only taken with --compressors, and not for brokered
+    connections whose commands the broker process sends """
+    return bool(options.compressors) and not isinstance(con, BrokerConnection)
+
+#
+# Compressors for --compressors, with the modules the driver needs for them
+# and the pymongo version that supports them first.
+#
+COMPRESSORS = [('zstd', 'zstandard', (3, 9)), ('snappy', 'snappy', (3, 7)), ('zlib', 'zlib', (3, 7))]
+
+# commands the driver never compresses
+UNCOMPRESSED_COMMANDS = set(['hello', 'ismaster', 'saslstart', 'saslcontinue', 'getnonce', 'authenticate', 'createuser', 'updateuser',
+                             'copydbsaslstart', 'copydbgetnonce', 'copydb'])
+
+# compressor agreed on with each server (address), as the ismaster reply of
+# mongo_connect tells it
+negotiated_compressors = {}
+
+
+def available_compressors(names):
+    """ The compressors of names the installed driver can use, in the given order """
+    available = []
+    for name in names:
+        module, version = [(module, version) for compressor, module, version in COMPRESSORS if compressor == name][0]
+        if pymongo.version_tuple < version:
+            continue
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+def wire_size(compressor, document):
+    """ Size of the OP_MSG carrying document, compressed with compressor if not None """
+    import bson
+    body = struct.pack('<iB', 0, 0) + bson.BSON.encode(document)
+    if compressor is None:
+        return 16 + len(body)
+    elif compressor == 'zlib':
+        import zlib
+        compressed = zlib.compress(body)
+    elif compressor == 'snappy':
+        import snappy
+        compressed = snappy.compress(body)
     else:
-        db.read_preference = pymongo.ReadPreference.SECONDARY
+        import zstandard
+        compressed = zstandard.ZstdCompressor().compress(body)
+    # header, original opcode, uncompressed size and compressor id
+    return 16 + 9 + len(compressed)
+
+
+def count_round_trips():
+    """ Register driver event listeners feeding round_trips (pymongo 3.1+) """
+    if round_trips.enabled:
+        return
+    import bson
+    from pymongo import monitoring
+
+    def command_compressor(event):
+        if event.command_name.lower() in UNCOMPRESSED_COMMANDS:
+            return None
+        return negotiated_compressors.get(event.connection_id)
+
+    def negotiated(event):
+        # only connections of runs with --compressors have their wire size taken
+        return event.connection_id in negotiated_compressors
+
+    class CommandCounter(monitoring.CommandListener):
+        def started(self, event):
+            wire_bytes = negotiated(event) and wire_size(command_compressor(event), event.command) or 0
+            round_trips.add(1, len(bson.BSON.encode(event.command)), 0, wire_bytes)
+
+        def succeeded(self, event):
+            wire_bytes = negotiated(event) and wire_size(command_compressor(event), event.reply) or 0
+            round_trips.add(0, 0, len(bson.BSON.encode(event.reply)), 0, wire_bytes)
+
+        def failed(self, event):
+            pass
+
+    class HeartbeatCounter(monitoring.ServerHeartbeatListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            round_trips.add(1)
+
+        def failed(self, event):
+            round_trips.add(1)
+
+    monitoring.register(CommandCounter())
+    monitoring.register(HeartbeatCounter())
+    if hasattr(monitoring, 'ConnectionPoolListener'):
+        class ConnectionCounter(monitoring.ConnectionPoolListener):
+            def connection_created(self, event):
+                round_trips.add(1)
+
+            def ignore(self, event):
+                pass
+
+            pool_created = pool_ready = pool_cleared = pool_closed = ignore
+            connection_ready = connection_closed = ignore
+            connection_check_out_started = connection_check_out_failed = ignore
+            connection_checked_out = connection_checked_in = ignore
+
+        monitoring.register(ConnectionCounter())
+    round_trips.enabled = True
+
+
+def add_performance_data(output, params):
+    """ Append perf data to the first line of a check's output """
+    lines = output.split('\n')
+    data = performance_data(True, params).strip()
+    if '|' in lines[0]:
+        data = data.lstrip('|')
+    lines[0] = lines[0].rstrip() + ' ' + data
+    return '\n'.join(lines)
+
+
+#
+# ismaster replies and server versions per connection, so that they are
+# asked at most once per run.
+#
+ismaster_replies = {}
+server_versions = {}
+
+# first server version speaking each wire protocol version
+WIRE_VERSIONS = [(25, (8, 0)), (21, (7, 0)), (17, (6, 0)), (13, (5, 0)), (9, (4, 4)), (8, (4, 2)), (7, (4, 0)),
+                 (6, (3, 6)), (5, (3, 4)), (4, (3, 2)), (3, (3, 0)), (2, (2, 6)), (0, (2, 0))]
+
+
+def get_ismaster(con):
+    if id(con) not in ismaster_replies:
+        ismaster_replies[id(con)] = con.admin.command("ismaster")
+    return ismaster_replies[id(con)]
+
+
+def wire_server_version(ismaster):
+    """ major.minor of the first server version speaking the wire version of an ismaster reply """
+    wire_version = ismaster.get('maxWireVersion', 0)
+    return [version for wire, version in WIRE_VERSIONS if wire_version >= wire][0]
+
+
+def get_server_version(con):
+    """ Version of the server as a tuple of ints. With --fast-connect only
+    major.minor, derived from the wire version of the ismaster reply,
+    otherwise from buildInfo. """
+    if id(con) not in server_versions:
+        server_versions[id(con)] = tuple(int(x) for x in re.findall(r'\d+', get_metadata(con, 'buildinfo')['version'])[:3])
+    return server_versions[id(con)]
+
+
+#
+# Metadata of the servers that rarely changes. It is kept in the state store
+# for --metadata-ttl seconds, but not past a restart of the server or a change
+# of the replica set configuration.
+#
+METADATA = {
+    'buildinfo': lambda con: con.admin.command("buildinfo"),
+    'hostinfo': lambda con: con.admin.command("hostInfo"),
+    'replset_config': lambda con: con.local.system.replset.find_one(),
+}
+
+# (host, port, ttl) of the connections using the cache
+metadata_caches = {}
+# documents already looked up in this run, keyed by connection
+metadata_documents = {}
+
+
+def server_identity(con):
+    """ Return the process id (MongoDB 4.4+, None before) and replica set
+    configuration version of the server from its ismaster reply """
+    ismaster = get_ismaster(con)
+    process_id = ismaster.get('topologyVersion', {}).get('processId')
+    return (process_id is not None and str(process_id) or None, ismaster.get('setVersion'))
+
+
+def get_metadata(con, name):
+    """ Return the METADATA document name of the server of con """
+    documents = metadata_documents.setdefault(id(con), {})
+    if name in documents:
+        return documents[name]
+    if id(con) not in metadata_caches:
+        documents[name] = METADATA[name](con)
+        return documents[name]
+
+    import bson
+    host, port, ttl = metadata_caches[id(con)]
+    process_id, set_version = server_identity(con)
+    db = open_state_store(host, port)
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, document BLOB NOT NULL, ts REAL NOT NULL, process_id TEXT, set_version INTEGER, uptime REAL)")
+        row = db.execute("SELECT document, ts, process_id, set_version, uptime FROM metadata WHERE name = ? AND ts > ?", (name, time.time() - ttl)).fetchone()
+        if row is not None and row[3] == set_version:
+            document, ts, stored_process_id, stored_set_version, uptime = row
+            if process_id is not None:
+                valid = process_id == stored_process_id
+            else:
+                # the server restarted if it has been up for less time than it was back then
+                valid = metadata_server_uptime(con) >= uptime + time.time() - ts - 60
+            if valid:
+                documents[name] = bson.BSON(document).decode()['value']
+                return documents[name]
+
+        documents[name] = METADATA[name](con)
+        uptime = process_id is None and metadata_server_uptime(con) or None
+        db.execute("INSERT OR REPLACE INTO metadata (name, document, ts, process_id, set_version, uptime) VALUES (?, ?, ?, ?, ?, ?)",
+                   (name, sqlite3.Binary(bson.BSON.encode({'value': documents[name]})), time.time(), process_id, set_version, uptime))
+        return documents[name]
+    finally:
+        db.close()
+
+
+def metadata_server_uptime(con):
+    """ Uptime of the server of con telling whether it restarted, from the
+    serverStatus the actions of the run share (leaving out the optional
+    sections they do not need), otherwise from one leaving out all of them """
+    if server_status_sections.get(id(con)) is None:
+        return server_uptime(fetch_server_status(con, []))
+    return server_uptime(get_server_status(con))
+
 
 def check_version(con):
     try:
-        server_info = con.server_info()
+        server_version = get_server_version(con)
     except Exception as e:
         return exit_with_general_critical(e), None
-    return 0, int(server_info['version'].split('.')[0].strip())
+    return 0, server_version[0]
+
+#
+# Connection broker: a long running process that keeps authenticated
+# connections per target open, so short lived checks only pay for a round
+# trip over a local unix socket instead of connect, TLS and authentication.
+#
+# Only actions that are built from database commands can be proxied, all
+# other actions always connect directly.
+#
+BROKER_ACTIONS = ['connections', 'replset_state', 'replset_quorum', 'memory', 'memory_mapped', 'queues', 'lock', 'current_lock',
+                  'flushing', 'last_flush_time', 'index_miss_ratio', 'databases', 'database_size', 'database_indexes',
+                  'collection_documents', 'collection_indexes', 'collection_size', 'collection_storageSize',
+                  'journal_commits_in_wl', 'write_data_files', 'journaled', 'opcounters', 'asserts', 'page_faults', 'counter_rate']
+
+
+def read_bson_message(sock):
+    """ Read one length prefixed BSON document from sock, None on EOF """
+    import bson
+    data = b''
+    length = 4
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+        if len(data) == 4:
+            length = struct.unpack('<i', data)[0]
+    return bson.BSON(data).decode()
+
+
+class BrokerConnection(object):
+    """ Stand-in for a MongoClient that forwards database commands to the broker """
+
+    def __init__(self, sock, target):
+        self.sock = sock
+        self.target = target
+        # requests of concurrent threads must not interleave on the socket
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return BrokerDatabase(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return BrokerDatabase(self, name)
+
+    def server_info(self):
+        return self.admin.command("buildinfo")
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, request):
+        import bson
+        request['target'] = self.target
+        data = bson.BSON.encode(request)
+        deadline = current_deadline()
+        if deadline is not None:
+            self.sock.settimeout(deadline.remaining())
+        try:
+            with self.lock:
+                self.sock.sendall(data)
+                reply = read_bson_message(self.sock)
+        except socket.timeout:
+            raise pymongo.errors.NetworkTimeout("No reply from broker in time")
+        if reply is None:
+            raise pymongo.errors.ConnectionFailure("Connection to broker closed")
+        if round_trips.enabled:
+            round_trips.add(1, len(data), len(bson.BSON.encode(reply)))
+        if not reply['ok']:
+            error = getattr(pymongo.errors, reply.get('type', ''), pymongo.errors.PyMongoError)
+            if issubclass(error, pymongo.errors.OperationFailure):
+                raise error(reply['errmsg'], reply.get('code'))
+            raise error(reply['errmsg'])
+        return reply.get('reply')
+
+
+class BrokerDatabase(object):
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def command(self, command, value=1, **kwargs):
+        if not isinstance(command, dict):
+            command = son.SON([(command, value)])
+        command.update(kwargs)
+        deadline = current_deadline()
+        if deadline is not None:
+            command['maxTimeMS'] = deadline.remaining_ms()
+        return self.connection.request({'db': self.name, 'command': command})
+
+
+def broker_connect(socket_path, target):
+    """ Return a BrokerConnection to target, or None if no broker is running
+    or the broker could not connect, so that the caller connects directly. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        con = BrokerConnection(sock, target)
+        con.request({'connect': 1})
+        return con
+    except (socket.error, pymongo.errors.PyMongoError):
+        sock.close()
+        return None
+
+
+def serve_broker(socket_path, idle_timeout):
+    """ Run the connection broker on socket_path until killed """
+    import bson
+    clients = {}
+    clients_lock = threading.Lock()
+
+    def get_client(target):
+        # lists (compressors) come back from JSON as lists, which are not hashable
+        key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in target.items()))
+        with clients_lock:
+            if key in clients:
+                clients[key][1] = time.time()
+                return clients[key][0]
+        # connect without holding the lock, a slow target must not block the others
+        try:
+            err, con = mongo_connect(**target)
+        except SystemExit:
+            err, con = 3, None
+        if err != 0:
+            return None
+        with clients_lock:
+            if key in clients:
+                con.close()
+            else:
+                clients[key] = [con, None]
+            clients[key][1] = time.time()
+            return clients[key][0]
+
+    def evict_idle_clients():
+        while True:
+            time.sleep(max(idle_timeout // 4, 1))
+            with clients_lock:
+                for key, (con, last_used) in list(clients.items()):
+                    if time.time() - last_used > idle_timeout:
+                        con.close()
+                        del clients[key]
+
+    def handle_request(request):
+        con = get_client(request['target'])
+        if con is None:
+            return {'ok': 0, 'type': 'ConnectionFailure', 'errmsg': 'broker could not connect'}
+        if 'connect' in request:
+            return {'ok': 1}
+        try:
+            return {'ok': 1, 'reply': con[request['db']].command(request['command'])}
+        except pymongo.errors.PyMongoError as e:
+            return {'ok': 0, 'type': e.__class__.__name__, 'errmsg': str(e), 'code': getattr(e, 'code', None)}
+
+    class BrokerHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            while True:
+                request = read_bson_message(self.request)
+                if request is None:
+                    return
+                self.request.sendall(bson.BSON.encode(handle_request(request)))
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, BrokerHandler)
+    os.chmod(socket_path, 0o600)
+    server.daemon_threads = True
+
+    reaper = threading.Thread(target=evict_idle_clients)
+    reaper.daemon = True
+    reaper.start()
+    server.serve_forever()
+
 
 def check_connect(host, port, warning, critical, perf_data, user, passwd, conn_time):
     warning = warning or 3
@@ -429,14 +1943,14 @@ def check_connections(con, warning, critical, perf_data):
         return exit_with_general_critical(e)
 
 
-def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf_data, max_lag, ssl=False, user=None, passwd=None, replicaset=None, authdb="admin", insecure=None, ssl_ca_cert_file=None, cert_file=None, auth_mechanism=None, retry_writes_disabled=False):
+def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf_data, max_lag, ssl=False, user=None, passwd=None, replicaset=None, authdb="admin", insecure=None, ssl_ca_cert_file=None, cert_file=None, auth_mechanism=None, retry_writes_disabled=False, rdns_cache_ttl=0, oplog_window_ttl=900, compressors=None):
     # Get mongo to tell us replica set member name when connecting locally
     if "127.0.0.1" == host:
-        if not "me" in list(con.admin.command("ismaster","1").keys()):
+        if not "me" in list(get_ismaster(con).keys()):
             print("UNKNOWN - This is not replicated MongoDB")
             return 3
 
-        host = con.admin.command("ismaster","1")["me"].split(':')[0]
+        host = get_ismaster(con)["me"].split(':')[0]
 
     if percent:
         warning = warning or 50
@@ -446,22 +1960,32 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
         critical = critical or 3600
     rs_status = {}
     slaveDelays = {}
-    try:
-        #set_read_preference(con.admin)
+    primary_connections = []
 
+    def connect_primary(primary_host, primary_port):
+        # only needed to refresh the oplog window of the primary now and then
+        if get_ismaster(con).get('ismaster'):
+            return 0, con
+        err, primary_con = mongo_connect(primary_host, primary_port, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled, compressors=compressors)
+        if err == 0:
+            primary_connections.append(primary_con)
+        return err, primary_con
+
+    try:
         # Get replica set status
         try:
             rs_status = con.admin.command("replSetGetStatus")
         except pymongo.errors.OperationFailure as e:
+            if is_timeout(e):
+                raise
             if ((e.code == None and str(e).find('failed: not running with --replSet"')) or (e.code == 76 and str(e).find('not running with --replSet"'))):
                 print("UNKNOWN - Not running with replSet")
                 return 3
-        serverVersion = tuple(con.server_info()['version'].split('.'))
-        if serverVersion >= tuple("2.0.0".split(".")):
+        if get_server_version(con) >= (2, 0, 0):
             #
             # check for version greater then 2.0
             #
-            rs_conf = con.local.system.replset.find_one()
+            rs_conf = get_metadata(con, 'replset_config')
             for member in rs_conf['members']:
                 if member.get('slaveDelay') is not None:
                     slaveDelays[member['host']] = member.get('slaveDelay')
@@ -472,15 +1996,19 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
             primary_node = None
             host_node = None
 
+            # if rdns_lookup is true then lookup both values back to their rdns value so we can compare hostname vs fqdn
+            if rdns_lookup:
+                member_hosts = [split_host_port(member.get('name'))[0] for member in rs_status["members"]]
+                names = resolve_rdns(member_hosts + [host], rdns_cache_ttl)
+
             for member in rs_status["members"]:
                 if member["stateStr"] == "PRIMARY":
                     primary_node = member
 
-                # if rdns_lookup is true then lookup both values back to their rdns value so we can compare hostname vs fqdn
                 if rdns_lookup:
                     member_host, member_port = split_host_port(member.get('name'))
-                    member_host = "{0}:{1}".format(socket.getnameinfo((member_host, 0), 0)[0], member_port)
-                    if member_host == "{0}:{1}".format(socket.getnameinfo((host, 0), 0)[0], port):
+                    member_host = "{0}:{1}".format(names[member_host], member_port)
+                    if member_host == "{0}:{1}".format(names[host], port):
                         host_node = member
                 # Exact match
                 elif member.get('name') == "{0}:{1}".format(host, port):
@@ -513,10 +2041,9 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
                             data = data + member['name'] + " lag=%d;" % replicationLag
                             maximal_lag = max(maximal_lag, replicationLag)
                     if percent:
-                        err, con = mongo_connect(split_host_port(primary_node['name'])[0], int(split_host_port(primary_node['name'])[1]), ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+                        err, primary_timediff = get_oplog_window(primary_node['name'], primary_node['optimeDate'], oplog_window_ttl, connect_primary)
                         if err != 0:
                             return err
-                        primary_timediff = replication_get_time_diff(con)
                         maximal_lag = int(float(maximal_lag) / float(primary_timediff) * 100)
                         message = "Maximal lag is " + str(maximal_lag) + " percents"
                         message += performance_data(perf_data, [(maximal_lag, "replication_lag_percent", warning, critical)])
@@ -545,10 +2072,9 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
                 lag = float(optime_lag.seconds + optime_lag.days * 24 * 3600)
 
             if percent:
-                err, con = mongo_connect(split_host_port(primary_node['name'])[0], int(split_host_port(primary_node['name'])[1]), ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+                err, primary_timediff = get_oplog_window(primary_node['name'], primary_node['optimeDate'], oplog_window_ttl, connect_primary)
                 if err != 0:
                     return err
-                primary_timediff = replication_get_time_diff(con)
                 if primary_timediff != 0:
                     lag = int(float(lag) / float(primary_timediff) * 100)
                 else:
@@ -589,10 +2115,9 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
             optime_lag = abs(primary_node[1] - host_node["optimeDate"])
             lag = optime_lag.seconds
             if percent:
-                err, con = mongo_connect(split_host_port(primary_node['name'])[0], int(split_host_port(primary_node['name'])[1]), ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+                err, primary_timediff = get_oplog_window(primary_node[0], primary_node[1], oplog_window_ttl, connect_primary)
                 if err != 0:
                     return err
-                primary_timediff = replication_get_time_diff(con)
                 lag = int(float(lag) / float(primary_timediff) * 100)
                 message = "Lag is " + str(lag) + " percents"
                 message += performance_data(perf_data, [(lag, "replication_lag_percent", warning, critical)])
@@ -603,6 +2128,9 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
 
     except Exception as e:
         return exit_with_general_critical(e)
+    finally:
+        for primary_con in primary_connections:
+            primary_con.close()
 
 #
 # Check the memory usage of mongo. Alerting on this may be hard to get right
@@ -610,22 +2138,29 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
 # a good thing.
 #
 def check_memory(con, warning, critical, perf_data, mapped_memory, host):
-    # Get the total system memory of this system (This is totally bogus if you
-    # are running this command remotely) and calculate based on that how much
-    # memory used by Mongodb is ok or not.
-    meminfo = open('/proc/meminfo').read()
-    matched = re.search(r'^MemTotal:\s+(\d+)', meminfo)
-    if matched:
-        mem_total_kB = int(matched.groups()[0])
-
-    if host != "127.0.0.1" and not warning:
+    # Get the total system memory of the server (hostInfo needs the
+    # clusterMonitor role, fall back to this system when running locally) and
+    # calculate based on that how much memory used by Mongodb is ok or not.
+    mem_total_kB = None
+    try:
+        mem_total_kB = get_metadata(con, 'hostinfo')['system']['memSizeMB'] * 1024
+    except Exception as e:
+        if is_timeout(e):
+            raise
+        if host == "127.0.0.1":
+            meminfo = open('/proc/meminfo').read()
+            matched = re.search(r'^MemTotal:\s+(\d+)', meminfo)
+            if matched:
+                mem_total_kB = int(matched.groups()[0])
+
+    if mem_total_kB is None and not warning:
       # Running remotely and value was not set by user, use hardcoded value
       warning = 12
     else:
-      # running locally or user provided value
+      # memory size known or user provided value
       warning = warning or (mem_total_kB * 0.8) / 1024.0 / 1024.0
 
-    if host != "127.0.0.1" and not critical:
+    if mem_total_kB is None and not critical:
       critical = 16
     else:
       critical = critical or (mem_total_kB * 0.9) / 1024.0 / 1024.0
@@ -782,8 +2317,7 @@ def index_miss_ratio(con, warning, critical, perf_data):
 
         try:
             data['indexCounters']
-            serverVersion = tuple(con.server_info()['version'].split('.'))
-            if serverVersion >= tuple("2.4.0".split(".")):
+            if get_server_version(con) >= (2, 4, 0):
                 miss_ratio = float(data['indexCounters']['missRatio'])
             else:
                 miss_ratio = float(data['indexCounters']['btree']['missRatio'])
@@ -851,7 +2385,6 @@ def check_replset_state(con, perf_data, warning="", critical=""):
         message = ""
         try:
             try:
-                set_read_preference(con.admin)
                 data = con.admin.command(pymongo.son_manipulator.SON([('replSetGetStatus', 1)]))
             except:
                 data = con.admin.command(son.SON([('replSetGetStatus', 1)]))
@@ -866,6 +2399,8 @@ def check_replset_state(con, perf_data, warning="", critical=""):
             message += performance_data(perf_data, [(my_state, "state")])
 
         except pymongo.errors.OperationFailure as e:
+            if is_timeout(e):
+                raise
             if ((e.code == None and str(e).find('failed: not running with --replSet"')) or (e.code == 76 and str(e).find('not running with --replSet"'))):
                 worst_state = -1
 
@@ -903,13 +2438,97 @@ def state_text(state):
         return  "Unknown state"
 
 
+def check_replset_members(con, warning, critical, perf_data, passive_file=None, passive_service="Mongo Replica Set Member"):
+    """ Check all members of the replica set from a single replSetGetStatus:
+    state, health, replication lag, heartbeat age and ping time. Prints one
+    line per member after the summary, and with passive_file also writes the
+    results of the members as passive service checks into that Nagios command
+    file. """
+    warning = warning or 600
+    critical = critical or 3600
+    try:
+        try:
+            status = con.admin.command("replSetGetStatus")
+        except pymongo.errors.OperationFailure as e:
+            if is_timeout(e):
+                raise
+            if e.code == 76 or (e.code is None and 'not running with --replSet' in str(e)):
+                print("UNKNOWN - Not running with replSet")
+                return 3
+            raise
+
+        delays = {}
+        config = get_metadata(con, 'replset_config') or {}
+        for member in config.get('members', []):
+            delays[member['host']] = member.get('secondaryDelaySecs', member.get('slaveDelay', 0))
+
+        now = status.get('date') or datetime.datetime.utcnow()
+        primaries = [member for member in status['members'] if member['state'] == 1]
+        primary = primaries and primaries[0] or None
+
+        results = []
+        for member in status['members']:
+            state, output = capture_action(check_replset_member, member, primary, delays.get(member['name'], 0), now, warning, critical, perf_data)
+            results.append((member['name'], state, output))
+    except Exception as e:
+        return exit_with_general_critical(e)
+
+    if passive_file:
+        f = open(passive_file, 'a')
+        for name, state, output in results:
+            f.write("[%i] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%i;%s\n" % (time.time(), split_host_port(name)[0], passive_service, state, " ".join(output.splitlines())))
+        f.close()
+
+    worst_state = max([r[1] for r in results], key=STATE_SEVERITY.index)
+    counts = [len([r for r in results if r[1] == state]) for state in (2, 1, 3)]
+    message = "%i members checked, %i critical, %i warning, %i unknown" % ((len(results),) + tuple(counts))
+    if primary is None:
+        worst_state = max(worst_state, 1, key=STATE_SEVERITY.index)
+        message += ", no primary defined. In an election?"
+    print("%s - %s" % (state_name(worst_state), message))
+    for name, state, output in results:
+        print("%s: %s" % (name, output))
+    return worst_state
+
+
+def check_replset_member(member, primary, delay, now, warning, critical, perf_data):
+    """ Evaluate one member entry of replSetGetStatus """
+    state = member['state']
+    message = "State: %i (%s)" % (state, state_text(state))
+    params = []
+    lag = 0
+    if state == 2 and primary is not None:
+        lag = max((primary['optimeDate'] - member['optimeDate']).total_seconds() - delay, 0)
+        message += ", lag %is" % lag
+        params.append((int(lag), "replication_lag", warning, critical))
+    if 'lastHeartbeat' in member:
+        heartbeat_age = max((now - member['lastHeartbeat']).total_seconds(), 0)
+        message += ", heartbeat %is ago" % heartbeat_age
+        params.append(("%is" % heartbeat_age, "heartbeat_age"))
+    if 'pingMs' in member:
+        message += ", ping %ims" % member['pingMs']
+        params.append(("%ims" % member['pingMs'], "ping"))
+    if params:
+        message += performance_data(perf_data, params)
+
+    if not member.get('health', 1):
+        print("CRITICAL - " + message + " (not reachable)")
+        return 2
+    if state in (8, 4, -1):
+        print("CRITICAL - " + message)
+        return 2
+    if state not in (1, 2, 7):
+        print("WARNING - " + message)
+        return 1
+    return check_levels(lag, warning, critical, message)
+
+
 def check_databases(con, warning, critical, perf_data=None):
     try:
         try:
-            set_read_preference(con.admin)
-            data = con.admin.command(pymongo.son_manipulator.SON([('listDatabases', 1)]))
+            data = read_database(con, 'admin').command(pymongo.son_manipulator.SON([('listDatabases', 1)]))
         except:
-            data = con.admin.command(son.SON([('listDatabases', 1)]))
+            data = read_database(con, 'admin').command(son.SON([('listDatabases', 1)]))
 
         count = len(data['databases'])
         message = "Number of DBs: %.0f" % count
@@ -919,19 +2538,11 @@ def check_databases(con, warning, critical, perf_data=None):
         return exit_with_general_critical(e)
 
 
-def check_collections(con, warning, critical, perf_data=None):
+def check_collections(con, host, port, warning, critical, perf_data=None, ttl=0, refresh_limit=500, workers=8):
     try:
-        try:
-            set_read_preference(con.admin)
-            data = con.admin.command(pymongo.son_manipulator.SON([('listDatabases', 1)]))
-        except:
-            data = con.admin.command(son.SON([('listDatabases', 1)]))
-
-        count = 0
-        for db in data['databases']:
-            dbase = con[db['name']]
-            set_read_preference(dbase)
-            count += len(dbase.collection_names())
+        databases = list_database_names(con)
+        stats = get_database_stats(con, host, port, 'collections', databases, ttl, refresh_limit, workers)
+        count = sum(stat['count'] for stat in stats.values())
 
         message = "Number of collections: %.0f" % count
         message += performance_data(perf_data, [(count, "collections", warning, critical, message)])
@@ -941,39 +2552,109 @@ def check_collections(con, warning, critical, perf_data=None):
         return exit_with_general_critical(e)
 
 
-def check_all_databases_size(con, warning, critical, perf_data):
+def check_all_databases_size(con, host, port, warning, critical, perf_data, top=10, ttl=0, refresh_limit=500, workers=8):
     warning = warning or 100
     critical = critical or 1000
     try:
-        set_read_preference(con.admin)
-        all_dbs_data = con.admin.command(pymongo.son_manipulator.SON([('listDatabases', 1)]))
-    except:
-        all_dbs_data = con.admin.command(son.SON([('listDatabases', 1)]))
-
-    total_storage_size = 0
-    message = ""
-    perf_data_param = [()]
-    for db in all_dbs_data['databases']:
-        database = db['name']
-        data = con[database].command('dbstats')
-        storage_size = round(data['storageSize'] / 1024 / 1024, 1)
-        message += "; Database %s size: %.0f MB" % (database, storage_size)
-        perf_data_param.append((storage_size, database + "_database_size"))
-        total_storage_size += storage_size
-
-    perf_data_param[0] = (total_storage_size, "total_size", warning, critical)
-    message += performance_data(perf_data, perf_data_param)
-    message = "Total size: %.0f MB" % total_storage_size + message
+        databases = list_database_names(con)
+        stats = get_database_stats(con, host, port, 'dbstats', databases, ttl, refresh_limit, workers)
+    except Exception as e:
+        return exit_with_general_critical(e)
+
+    sizes = sorted([(round(stat['storageSize'] / 1024 / 1024, 1), database) for database, stat in stats.items()], reverse=True)
+    total_storage_size = sum(size for size, database in sizes)
+    largest = sizes[:top]
+
+    message = "Total size: %.0f MB in %i databases" % (total_storage_size, len(sizes))
+    if largest:
+        message += ", largest: " + ", ".join("%s %.0f MB" % (database, size) for size, database in largest)
+    message += performance_data(perf_data, [(total_storage_size, "total_size", warning, critical)] +
+                                [(size, database + "_database_size") for size, database in largest])
     return check_levels(total_storage_size, warning, critical, message)
 
 
+def list_database_names(con):
+    command = [('listDatabases', 1)]
+    if get_server_version(con) >= (3, 6):
+        # do not let the server compute the size of every database
+        command.append(('nameOnly', True))
+    try:
+        data = read_database(con, 'admin').command(pymongo.son_manipulator.SON(command))
+    except:
+        data = read_database(con, 'admin').command(son.SON(command))
+    return [db['name'] for db in data['databases']]
+
+
+def fetch_dbstats(db):
+    data = db.command('dbstats')
+    return {'storageSize': data['storageSize'], 'indexSize': data.get('indexSize', 0)}
+
+
+def fetch_collection_count(db):
+    if hasattr(db, 'list_collection_names'):
+        # listCollections with nameOnly, pymongo 3.7+
+        return {'count': len(db.list_collection_names())}
+    return {'count': len(db.collection_names())}
+
+
+DATABASE_STATS = {
+    'dbstats': fetch_dbstats,
+    'collections': fetch_collection_count,
+}
+
+
+def get_database_stats(con, host, port, kind, databases, ttl=0, refresh_limit=500, workers=8):
+    """ Return {database: stats} of the DATABASE_STATS kind for all databases.
+    With a ttl the stats are kept in the state store: younger entries are used
+    as they are, older ones are used stale while the refresh_limit oldest of
+    them are fetched again, so that thousands of databases get refreshed over
+    a few runs. Missing entries are always fetched. Fetching runs on up to
+    workers databases at the same time. """
+    import bson
+    stats = {}
+    fetched_at = {}
+    db = None
+    if ttl > 0:
+        db = open_state_store(host, port)
+        db.execute("CREATE TABLE IF NOT EXISTS database_stats (kind TEXT NOT NULL, database TEXT NOT NULL, stats BLOB NOT NULL, ts REAL NOT NULL, PRIMARY KEY (kind, database))")
+    try:
+        if db is not None:
+            for database, data, ts in db.execute("SELECT database, stats, ts FROM database_stats WHERE kind = ?", (kind,)):
+                stats[database] = bson.BSON(data).decode()
+                fetched_at[database] = ts
+        missing = [database for database in databases if database not in stats]
+        stale = sorted([database for database in databases if database in stats and fetched_at[database] < time.time() - ttl], key=fetched_at.get)
+        todo = missing + stale[:refresh_limit]
+
+        handles = dict((database, read_database(con, database)) for database in todo)
+        results = map_concurrently(lambda database: DATABASE_STATS[kind](handles[database]), todo, workers)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        fetched = [(database, result) for database, result in zip(todo, results) if not isinstance(result, BaseException)]
+        stats.update(fetched)
+
+        if db is not None:
+            # keep what was fetched even if some databases failed, the next run goes on from there
+            db.execute("BEGIN IMMEDIATE")
+            for database, result in fetched:
+                db.execute("INSERT OR REPLACE INTO database_stats (kind, database, stats, ts) VALUES (?, ?, ?, ?)",
+                           (kind, database, sqlite3.Binary(bson.BSON.encode(result)), time.time()))
+            for database in set(stats) - set(databases):
+                db.execute("DELETE FROM database_stats WHERE kind = ? AND database = ?", (kind, database))
+            db.execute("COMMIT")
+        if errors:
+            raise errors[0]
+    finally:
+        if db is not None:
+            db.close()
+    return dict((database, stats[database]) for database in databases)
+
+
 def check_database_size(con, database, warning, critical, perf_data):
     warning = warning or 100
     critical = critical or 1000
     perfdata = ""
     try:
-        set_read_preference(con.admin)
-        data = con[database].command('dbstats')
+        data = read_database(con, database).command('dbstats')
         storage_size = data['storageSize'] // 1024 // 1024
         if perf_data:
             perfdata += " | database_size=%i;%i;%i" % (storage_size, warning, critical)
@@ -1000,8 +2681,7 @@ def check_database_indexes(con, database, warning, critical, perf_data):
     critical = critical or 1000
     perfdata = ""
     try:
-        set_read_preference(con.admin)
-        data = con[database].command('dbstats')
+        data = read_database(con, database).command('dbstats')
         index_size = data['indexSize'] / 1024 // 1024
         if perf_data:
             perfdata += " | database_indexes=%i;%i;%i" % (index_size, warning, critical)
@@ -1022,8 +2702,7 @@ def check_database_indexes(con, database, warning, critical, perf_data):
 def check_collection_documents(con, database, collection, warning, critical, perf_data):
     perfdata = ""
     try:
-        set_read_preference(con.admin)
-        data = con[database].command('collstats', collection)
+        data = read_database(con, database).command('collstats', collection)
         documents = data['count']
         if perf_data:
             perfdata += " | collection_documents=%i;%i;%i" % (documents, warning, critical)
@@ -1049,8 +2728,7 @@ def check_collection_indexes(con, database, collection, warning, critical, perf_
     critical = critical or 1000
     perfdata = ""
     try:
-        set_read_preference(con.admin)
-        data = con[database].command('collstats', collection)
+        data = read_database(con, database).command('collstats', collection)
         total_index_size = data['totalIndexSize'] / 1024 / 1024
         if perf_data:
             perfdata += " | collection_indexes=%i;%i;%i" % (total_index_size, warning, critical)
@@ -1068,6 +2746,117 @@ def check_collection_indexes(con, database, collection, warning, critical, perf_
         return exit_with_general_critical(e)
 
 
+#
+# Collection actions that can check all collections matching --namespace:
+# (name in the output, value from collstats, format, default warning and critical)
+#
+COLLECTION_METRICS = {
+    'collection_documents': ('documents', lambda data: data['count'], "%s", None, None),
+    'collection_indexes': ('totalIndexSize', lambda data: data['totalIndexSize'] / 1024 / 1024, "%.0f MB", 100, 1000),
+    'collection_size': ('size', lambda data: data['size'] / 1024 / 1024, "%.0f MB", 100, 1000),
+    'collection_storageSize': ('storageSize', lambda data: data['storageSize'] / 1024 / 1024, "%.0f MB", 100, 1000),
+}
+
+# collstats of the collections matching a namespace pattern, keyed by
+# connection and pattern, shared by all collection actions of a run
+collection_stats = {}
+
+
+def list_collection_names(db):
+    """ Names of the collections of db, without views and system collections """
+    if hasattr(db, 'list_collections'):
+        # pymongo 3.6+
+        names = [info['name'] for info in db.list_collections(nameOnly=True) if info.get('type', 'collection') == 'collection']
+    else:
+        names = db.collection_names()
+    return [name for name in names if not name.startswith('system.')]
+
+
+def regex_literal_prefix(pattern):
+    """ Literal text all matches of a regular expression anchored with ^ start with """
+    if not pattern.startswith('^') or '|' in pattern:
+        return ''
+    prefix = ''
+    i = 1
+    while i < len(pattern):
+        char, step = pattern[i], 1
+        if char == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            char, step = pattern[i + 1], 2
+        elif char in '.^$*+?{}[]\\()':
+            break
+        if pattern[i + step:i + step + 1] in ('*', '?', '{', '+'):
+            break
+        prefix += char
+        i += step
+    return prefix
+
+
+def get_collection_stats(con, pattern, workers=8):
+    """ Return {namespace: collstats} of all collections whose namespace
+    (database.collection) matches the regular expression pattern """
+    stats = collection_stats.setdefault(id(con), {})
+    if pattern in stats:
+        return stats[pattern]
+
+    regex = re.compile(pattern)
+    # only list the collections of databases the pattern can match
+    prefix = regex_literal_prefix(pattern)
+    if '.' in prefix:
+        databases = [database for database in list_database_names(con) if database == prefix.split('.')[0]]
+    else:
+        databases = [database for database in list_database_names(con) if database.startswith(prefix)]
+    namespaces = []
+    handles = dict((database, read_database(con, database)) for database in databases)
+    for database, names in zip(databases, map_concurrently(lambda database: list_collection_names(handles[database]), databases, workers)):
+        if isinstance(names, BaseException):
+            raise names
+        namespaces += [(database, name) for name in names if regex.search("%s.%s" % (database, name))]
+
+    stats[pattern] = {}
+    results = map_concurrently(lambda namespace: handles[namespace[0]].command('collstats', namespace[1]), namespaces, workers)
+    for (database, name), data in zip(namespaces, results):
+        if isinstance(data, pymongo.errors.OperationFailure) and data.code == 26:
+            # dropped in the meantime
+            continue
+        if isinstance(data, BaseException):
+            raise data
+        stats[pattern]["%s.%s" % (database, name)] = data
+    return stats[pattern]
+
+
+def check_collections_matching(con, action, pattern, warning, critical, perf_data, top=10, workers=8):
+    """ Check the COLLECTION_METRICS value of action for all collections
+    matching pattern: the summary is followed by a line for every collection
+    exceeding a threshold, perf data is given for the top largest values """
+    label, value_of, value_format, default_warning, default_critical = COLLECTION_METRICS[action]
+    warning = warning or default_warning or 0
+    critical = critical or default_critical or 0
+    try:
+        stats = get_collection_stats(con, pattern, workers)
+    except Exception as e:
+        return exit_with_general_critical(e)
+    if not stats:
+        print("UNKNOWN - No collection matches %s" % pattern)
+        return 3
+
+    values = sorted([(value_of(data), namespace) for namespace, data in stats.items()], reverse=True)
+    problems = []
+    for value, namespace in values:
+        if value >= critical:
+            problems.append((2, "CRITICAL - %s %s: %s" % (namespace, label, value_format % value)))
+        elif value >= warning:
+            problems.append((1, "WARNING - %s %s: %s" % (namespace, label, value_format % value)))
+
+    states = [state for state, line in problems]
+    worst_state = max(states + [0], key=STATE_SEVERITY.index)
+    message = "%s - %i collections matching %s checked, %i critical, %i warning" % (state_name(worst_state), len(values), pattern, states.count(2), states.count(1))
+    message += performance_data(perf_data, [(int(value), "'%s_%s'" % (namespace, action), warning, critical) for value, namespace in values[:top]])
+    print(message)
+    for state, line in sorted(problems, key=lambda problem: -problem[0]):
+        print(line)
+    return worst_state
+
+
 def check_queues(con, warning, critical, perf_data):
     warning = warning or 10
     critical = critical or 30
@@ -1089,8 +2878,7 @@ def check_collection_size(con, database, collection, warning, critical, perf_dat
     critical = critical or 1000
     perfdata = ""
     try:
-        set_read_preference(con.admin)
-        data = con[database].command('collstats', collection)
+        data = read_database(con, database).command('collstats', collection)
         size = data['size'] / 1024 / 1024
         if perf_data:
             perfdata += " | collection_size=%i;%i;%i" % (size, warning, critical)
@@ -1113,8 +2901,7 @@ def check_collection_storageSize(con, database, collection, warning, critical, p
     critical = critical or 1000
     perfdata = ""
     try:
-        set_read_preference(con.admin)
-        data = con[database].command('collstats', collection)
+        data = read_database(con, database).command('collstats', collection)
         storageSize = data['storageSize'] / 1024 / 1024
         if perf_data:
             perfdata += " | collection_storageSize=%i;%i;%i" % (storageSize, warning, critical)
@@ -1132,68 +2919,35 @@ def check_collection_storageSize(con, database, collection, warning, critical, p
         return exit_with_general_critical(e)
 
 
-def check_queries_per_second(con, query_type, warning, critical, perf_data, mongo_version):
+def check_queries_per_second(con, host, port, query_type, warning, critical, perf_data):
+    """ Rates of all opcounters from one serverStatus snapshot, the thresholds
+    apply to the rate of query_type. The previous values are kept in the local
+    state store, not in the monitored server. """
     warning = warning or 250
     critical = critical or 500
 
-    if query_type not in ['insert', 'query', 'update', 'delete', 'getmore', 'command']:
+    if query_type not in OPCOUNTERS:
         return exit_with_general_critical("The query type of '%s' is not valid" % query_type)
 
     try:
-        db = con.local
         data = get_server_status(con)
-
-        # grab the count
-        num = int(data['opcounters'][query_type])
-
-        # do the math
-        last_count = db.nagios_check.find_one({'check': 'query_counts'})
-        try:
-            ts = int(time.time())
-            diff_query = num - last_count['data'][query_type]['count']
-            diff_ts = ts - last_count['data'][query_type]['ts']
-
-            if diff_ts == 0:
-                message = "diff_query = " + str(diff_query) + " diff_ts = " + str(diff_ts)
-                return check_levels(0, warning, critical, message)
-
-            query_per_sec = float(diff_query) / float(diff_ts)
-
-            # update the count now
-            if mongo_version == 2:
-                db.nagios_check.update({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.update_one({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-
-            message = "Queries / Sec: %f" % query_per_sec
-            message += performance_data(perf_data, [(query_per_sec, "%s_per_sec" % query_type, warning, critical, message)])
-        except KeyError:
-            #
-            # since it is the first run insert it
-            query_per_sec = 0
-            message = "First run of check.. no data"
-            if mongo_version == 2:
-                db.nagios_check.update({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.update_one({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-
-        except TypeError:
-            #
-            # since it is the first run insert it
-            query_per_sec = 0
-            message = "First run of check.. no data"
-            if mongo_version == 2:
-                db.nagios_check.insert({'check': 'query_counts', 'data': {query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.insert_one({'check': 'query_counts', 'data': {query_type: {'count': num, 'ts': int(time.time())}}})
-
+        rates = get_counter_rates(data, host, port, ['opcounters.'], 'queries_per_second')
+        if not rates:
+            return exit_first_run()
+
+        query_per_sec = rates.get('opcounters.' + query_type, 0)
+        message = "Queries / Sec: %f" % query_per_sec
+        message += performance_data(perf_data, [(query_per_sec, "%s_per_sec" % query_type, warning, critical)] +
+                                    [(rates.get('opcounters.' + name, 0), "%s_per_sec" % name) for name in OPCOUNTERS if name != query_type])
         return check_levels(query_per_sec, warning, critical, message)
 
     except Exception as e:
+        if is_timeout(e):
+            raise
         return exit_with_general_critical(e)
 
 
-def check_oplog(con, warning, critical, perf_data):
+def check_oplog(con, host, port, warning, critical, perf_data, ttl=900):
     """ Checking the oplog time - the time of the log currntly saved in the oplog collection
     defaults:
         critical 4 hours
@@ -1202,41 +2956,123 @@ def check_oplog(con, warning, critical, perf_data):
     warning = warning or 24
     critical = critical or 4
     try:
-        db = con.local
-        ol = db.system.namespaces.find_one({"name": "local.oplog.rs"})
-        if (db.system.namespaces.find_one({"name": "local.oplog.rs"}) != None):
-            oplog = "oplog.rs"
-        else:
-            ol = db.system.namespaces.find_one({"name": "local.oplog.$main"})
-            if (db.system.namespaces.find_one({"name": "local.oplog.$main"}) != None):
-                oplog = "oplog.$main"
-            else:
-                message = "neither master/slave nor replica set replication detected"
-                return check_levels(None, warning, critical, message)
-
-        try:
-                set_read_preference(con.admin)
-                data = con.local.command(pymongo.son_manipulator.SON([('collstats', oplog)]))
-        except:
-                data = con.admin.command(son.SON([('collstats', oplog)]))
+        oplog = oplog_collection_name(con)
+        if oplog is None:
+            message = "neither master/slave nor replica set replication detected"
+            return check_levels(None, warning, critical, message)
 
+        data = con.local.command("collstats", oplog)
         ol_size = data['size']
         ol_storage_size = data['storageSize']
         ol_used_storage = int(float(ol_size) / ol_storage_size * 100 + 1)
-        ol = con.local[oplog]
-        firstc = ol.find().sort("$natural", pymongo.ASCENDING).limit(1)[0]['ts']
-        lastc = ol.find().sort("$natural", pymongo.DESCENDING).limit(1)[0]['ts']
-        time_in_oplog = (lastc.as_datetime() - firstc.as_datetime())
+        err, first = cached_oplog_first(host, port, ttl, lambda: (0, oplog_first_ts(con, oplog).time))
+        if err != 0:
+            return err
+        seconds_in_oplog = oplog_last_ts(con, oplog).time - first
+        time_in_oplog = datetime.timedelta(seconds=seconds_in_oplog)
         message = "Oplog saves " + str(time_in_oplog) + " %d%% used" % ol_used_storage
-        try:  # work starting from python2.7
-            hours_in_oplog = time_in_oplog.total_seconds() / 60 / 60
-        except:
-            hours_in_oplog = float(time_in_oplog.seconds + time_in_oplog.days * 24 * 3600) / 60 / 60
+        hours_in_oplog = float(seconds_in_oplog) / 60 / 60
         approx_level = hours_in_oplog * 100 / ol_used_storage
         message += performance_data(perf_data, [("%.2f" % hours_in_oplog, 'oplog_time', warning, critical), ("%.2f " % approx_level, 'oplog_time_100_percent_used')])
         return check_levels(-approx_level, -warning, -critical, message)
 
     except Exception as e:
+        if is_timeout(e):
+            raise
+        return exit_with_general_critical(e)
+
+
+#
+# Oplog entry types, as names for messages and perf data
+#
+OPLOG_OPERATIONS = {'i': 'insert', 'u': 'update', 'd': 'delete', 'c': 'command', 'n': 'noop', 'db': 'db'}
+
+
+def oplog_throughput(con, oplog, since):
+    """ Return a dict of (number, bytes, last ts) of the oplog entries after
+    the timestamp since, keyed by (namespace, operation). Servers that have
+    $bsonSize (4.4+) group the entries themselves, older ones send them. """
+    collection = con.local[oplog]
+    groups = {}
+    if get_server_version(con) >= (4, 4):
+        pipeline = [{'$match': {'ts': {'$gt': since}}},
+                    {'$group': {'_id': {'ns': '$ns', 'op': '$op'}, 'n': {'$sum': 1}, 'bytes': {'$sum': {'$bsonSize': '$$ROOT'}}, 'last': {'$max': '$ts'}}}]
+        for group in collection.aggregate(pipeline):
+            groups[(group['_id'].get('ns', ''), group['_id'].get('op', ''))] = (group['n'], group['bytes'], group['last'])
+        return groups
+
+    from bson.raw_bson import RawBSONDocument
+    from bson.codec_options import CodecOptions
+    collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    for entry in collection.find({'ts': {'$gt': since}}):
+        key = (entry.get('ns', ''), entry.get('op', ''))
+        number, size, last = groups.get(key, (0, 0, since))
+        groups[key] = (number + 1, size + len(entry.raw), max(last, entry['ts']))
+    return groups
+
+
+def check_oplog_throughput(con, host, port, warning, critical, perf_data, top=10, ttl=900):
+    """ Oplog entries and bytes written per second, by namespace and
+    operation. Only the entries after the last one seen by the previous run
+    are read; the thresholds apply to the entries per second. """
+    from bson.timestamp import Timestamp
+    warning = warning or 1000
+    critical = critical or 2000
+    try:
+        oplog = oplog_collection_name(con)
+        if oplog is None:
+            message = "neither master/slave nor replica set replication detected"
+            return check_levels(None, warning, critical, message)
+
+        db = open_state_store(host, port)
+        try:
+            # BEGIN IMMEDIATE keeps concurrent runs from reading the same entries twice
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                stored = db.execute("SELECT value, ts FROM counters WHERE series = 'oplog_position' AND name = 'last'").fetchone()
+                now = time.time()
+                if stored is None:
+                    last = oplog_last_ts(con, oplog)
+                    groups = None
+                else:
+                    since = Timestamp(int(stored[0]) >> 32, int(stored[0]) & 0xffffffff)
+                    groups = oplog_throughput(con, oplog, since)
+                    last = max([since] + [group_last for number, size, group_last in groups.values()])
+                db.execute("INSERT OR REPLACE INTO counters (series, name, value, ts) VALUES ('oplog_position', 'last', ?, ?)", ((last.time << 32) + last.inc, now))
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+        err, first = cached_oplog_first(host, port, ttl, lambda: (0, oplog_first_ts(con, oplog).time))
+        if err != 0:
+            return err
+        window = last.time - first
+        if groups is None:
+            return check_levels(0, warning, critical, "No previous oplog position stored yet, rates are available from the next run on")
+
+        elapsed = max(now - stored[1], 1)
+        rates = sorted([(size / elapsed, number / elapsed, namespace, OPLOG_OPERATIONS.get(operation, operation))
+                        for (namespace, operation), (number, size, group_last) in groups.items()], reverse=True)
+        ops_per_sec = sum(ops for size, ops, namespace, operation in rates)
+        bytes_per_sec = sum(size for size, ops, namespace, operation in rates)
+        largest = rates[:top]
+
+        message = "Oplog: %.1f entries/s, %.1f kB/s, window %.1f hours" % (ops_per_sec, bytes_per_sec / 1024, float(window) / 3600)
+        if largest:
+            message += ", top: " + ", ".join("%s %s %.1f kB/s" % (namespace or "-", operation, size / 1024) for size, ops, namespace, operation in largest)
+        perfdata = [("%.2f" % ops_per_sec, "oplog_ops_per_sec", warning, critical), ("%.0fB" % bytes_per_sec, "oplog_bytes_per_sec"), ("%.2f" % (float(window) / 3600), "oplog_time")]
+        for size, ops, namespace, operation in largest:
+            perfdata.append(("%.2f" % ops, "'%s_%s_ops_per_sec'" % (namespace, operation)))
+            perfdata.append(("%.0fB" % size, "'%s_%s_bytes_per_sec'" % (namespace, operation)))
+        message += performance_data(perf_data, perfdata)
+        return check_levels(ops_per_sec, warning, critical, message)
+
+    except Exception as e:
+        if is_timeout(e):
+            raise
         return exit_with_general_critical(e)
 
 
@@ -1291,41 +3127,23 @@ than the amount physically written to disk."""
         return exit_with_general_critical(e)
 
 
-def get_opcounters(data, opcounters_name, host, port):
-    try:
-        insert = data[opcounters_name]['insert']
-        query = data[opcounters_name]['query']
-        update = data[opcounters_name]['update']
-        delete = data[opcounters_name]['delete']
-        getmore = data[opcounters_name]['getmore']
-        command = data[opcounters_name]['command']
-    except KeyError as e:
-        return 0, [0] * 100
-    total_commands = insert + query + update + delete + getmore + command
-    new_vals = [total_commands, insert, query, update, delete, getmore, command]
-    return  maintain_delta(new_vals, host, port, opcounters_name)
-
-
 def check_opcounters(con, host, port, warning, critical, perf_data):
     """ A function to get all opcounters delta per minute. In case of a replication - gets the opcounters+opcountersRepl"""
     warning = warning or 10000
     critical = critical or 15000
 
     data = get_server_status(con)
-    err1, delta_opcounters = get_opcounters(data, 'opcounters', host, port)
-    err2, delta_opcounters_repl = get_opcounters(data, 'opcountersRepl', host, port)
-    if err1 == 0 and err2 == 0:
-        delta = [(x + y) for x, y in zip(delta_opcounters, delta_opcounters_repl)]
-        delta[0] = delta_opcounters[0]  # only the time delta shouldn't be summarized
-        per_minute_delta = [int(x / delta[0] * 60) for x in delta[1:]]
-        message = "Test succeeded , old values missing"
-        message = "Opcounters: total=%d,insert=%d,query=%d,update=%d,delete=%d,getmore=%d,command=%d" % tuple(per_minute_delta)
-        message += performance_data(perf_data, ([(per_minute_delta[0], "total", warning, critical), (per_minute_delta[1], "insert"),
-                    (per_minute_delta[2], "query"), (per_minute_delta[3], "update"), (per_minute_delta[4], "delete"),
-                    (per_minute_delta[5], "getmore"), (per_minute_delta[6], "command")]))
-        return check_levels(per_minute_delta[0], warning, critical, message)
-    else:
-        return exit_with_general_critical("problem reading data from temp file")
+    rates = get_counter_rates(data, host, port, RATE_COUNTERS['opcounters'], 'opcounters')
+    if 'opcounters' in data and not rates:
+        return exit_first_run()
+
+    per_minute_delta = [int((rates.get('opcounters.' + name, 0) + rates.get('opcountersRepl.' + name, 0)) * 60) for name in OPCOUNTERS]
+    per_minute_delta = [sum(per_minute_delta)] + per_minute_delta
+    message = "Opcounters: total=%d,insert=%d,query=%d,update=%d,delete=%d,getmore=%d,command=%d" % tuple(per_minute_delta)
+    message += performance_data(perf_data, ([(per_minute_delta[0], "total", warning, critical), (per_minute_delta[1], "insert"),
+                (per_minute_delta[2], "query"), (per_minute_delta[3], "update"), (per_minute_delta[4], "delete"),
+                (per_minute_delta[5], "getmore"), (per_minute_delta[6], "command")]))
+    return check_levels(per_minute_delta[0], warning, critical, message)
 
 
 def check_current_lock(con, host, port, warning, critical, perf_data):
@@ -1334,39 +3152,63 @@ def check_current_lock(con, host, port, warning, critical, perf_data):
     critical = critical or 30
     data = get_server_status(con)
 
-    lockTime = float(data['globalLock']['lockTime'])
-    totalTime = float(data['globalLock']['totalTime'])
+    if 'lockTime' not in data['globalLock']:
+        print("OK - MongoDB version 3 doesn't report on global locks")
+        return 0
 
-    err, delta = maintain_delta([totalTime, lockTime], host, port, "locktime")
-    if err == 0:
-        lock_percentage = delta[2] / delta[1] * 100     # lockTime/totalTime*100
+    rates = get_counter_rates(data, host, port, RATE_COUNTERS['current_lock'], 'current_lock')
+    if len(rates) == 2 and rates['globalLock.totalTime'] > 0:
+        lock_percentage = rates['globalLock.lockTime'] / rates['globalLock.totalTime'] * 100
         message = "Current Lock Percentage: %.2f%%" % lock_percentage
         message += performance_data(perf_data, [("%.2f" % lock_percentage, "current_lock_percentage", warning, critical)])
         return check_levels(lock_percentage, warning, critical, message)
     else:
-        return exit_with_general_warning("problem reading data from temp file")
+        return exit_first_run()
 
 
-def check_page_faults(con, host, port, warning, critical, perf_data):
-    """ A function to get page_faults per second from the system"""
+def check_page_faults(con, host, port, warning, critical, perf_data, samples=1, sample_interval=100):
+    """ A function to get page_faults per second from the system. The rate is the one since the
+    previous run, or with samples > 1 the min/avg/max rate of serverStatus samples taken
+    sample_interval milliseconds apart."""
     warning = warning or 10
     critical = critical or 30
     data = get_server_status(con)
 
-    try:
-        page_faults = float(data['extra_info']['page_faults'])
-    except:
+    if 'page_faults' not in data.get('extra_info', {}):
         # page_faults unsupported on the underlaying system
         return exit_with_general_critical("page_faults unsupported on the underlaying system")
 
-    err, delta = maintain_delta([page_faults], host, port, "page_faults")
-    if err == 0:
-        page_faults_ps = delta[1] / delta[0]
+    if samples > 1:
+        snapshots = [data]
+        for i in range(samples - 1):
+            time.sleep(sample_interval / 1000.0)
+            snapshots.append(fetch_server_status(con, server_status_sections.get(id(con), [])))
+        # keep the stored value current for runs without samples
+        get_counter_rates(snapshots[-1], host, port, RATE_COUNTERS['page_faults'], 'page_faults')
+
+        rates = []
+        for old, new in zip(snapshots, snapshots[1:]):
+            elapsed = server_uptime(new) - server_uptime(old)
+            if elapsed > 0:
+                rates.append(max(new['extra_info']['page_faults'] - old['extra_info']['page_faults'], 0) / elapsed)
+        if not rates:
+            return exit_with_general_warning("server uptime did not advance between the samples, increase --sample-interval")
+
+        elapsed = server_uptime(snapshots[-1]) - server_uptime(snapshots[0])
+        page_faults_ps = max(snapshots[-1]['extra_info']['page_faults'] - snapshots[0]['extra_info']['page_faults'], 0) / elapsed
+        message = "Page faults : %.2f ps (min %.2f ps, max %.2f ps over %i samples)" % (page_faults_ps, min(rates), max(rates), samples)
+        message += performance_data(perf_data, [("%.2f" % page_faults_ps, "page_faults_ps", warning, critical),
+                    ("%.2f" % min(rates), "page_faults_ps_min"), ("%.2f" % max(rates), "page_faults_ps_max")])
+        return check_levels(page_faults_ps, warning, critical, message)
+
+    rates = get_counter_rates(data, host, port, RATE_COUNTERS['page_faults'], 'page_faults')
+    if rates:
+        page_faults_ps = rates['extra_info.page_faults']
         message = "Page faults : %.2f ps" % page_faults_ps
         message += performance_data(perf_data, [("%.2f" % page_faults_ps, "page_faults_ps", warning, critical)])
         return check_levels(page_faults_ps, warning, critical, message)
     else:
-        return exit_with_general_warning("problem reading data from temp file")
+        return exit_first_run()
 
 
 def check_asserts(con, host, port, warning, critical, perf_data):
@@ -1375,50 +3217,71 @@ def check_asserts(con, host, port, warning, critical, perf_data):
     critical = critical or 10
     data = get_server_status(con)
 
-    asserts = data['asserts']
-
     #{ "regular" : 0, "warning" : 6, "msg" : 0, "user" : 12, "rollovers" : 0 }
-    regular = asserts['regular']
-    warning_asserts = asserts['warning']
-    msg = asserts['msg']
-    user = asserts['user']
-    rollovers = asserts['rollovers']
-
-    err, delta = maintain_delta([regular, warning_asserts, msg, user, rollovers], host, port, "asserts")
+    rates = get_counter_rates(data, host, port, RATE_COUNTERS['asserts'], 'asserts')
 
-    if err == 0:
-        if delta[5] != 0:
+    if rates:
+        if rates.get('asserts.rollovers'):
             #the number of rollovers were increased
             warning = -1  # no matter the metrics this situation should raise a warning
             # if this is normal rollover - the warning will not appear again, but if there will be a lot of asserts
             # the warning will stay for a long period of time
             # although this is not a usual situation
 
-        regular_ps = delta[1] / delta[0]
-        warning_ps = delta[2] / delta[0]
-        msg_ps = delta[3] / delta[0]
-        user_ps = delta[4] / delta[0]
-        rollovers_ps = delta[5] / delta[0]
+        regular_ps = rates.get('asserts.regular', 0)
+        warning_ps = rates.get('asserts.warning', 0)
+        msg_ps = rates.get('asserts.msg', 0)
+        user_ps = rates.get('asserts.user', 0)
         total_ps = regular_ps + warning_ps + msg_ps + user_ps
         message = "Total asserts : %.2f ps" % total_ps
         message += performance_data(perf_data, [(total_ps, "asserts_ps", warning, critical), (regular_ps, "regular"),
                     (warning_ps, "warning"), (msg_ps, "msg"), (user_ps, "user")])
         return check_levels(total_ps, warning, critical, message)
     else:
-        return exit_with_general_warning("problem reading data from temp file")
+        return exit_first_run()
 
 
-def get_stored_primary_server_name(db):
-    """ get the stored primary server name from db. """
-    if "last_primary_server" in db.collection_names():
-        stored_primary_server = db.last_primary_server.find_one()["server"]
-    else:
-        stored_primary_server = None
+def check_counter_rate(con, host, port, counters, warning, critical, perf_data):
+    """ Per second rate of any serverStatus counters, alerting on the sum of them """
+    if not counters:
+        return exit_with_general_critical("the counter_rate action needs --counters")
+    names = [name.strip() for name in counters.split(',')]
+    data = get_server_status(con)
+    if not select_counters(flatten_counters(data), names):
+        return exit_with_general_critical("serverStatus has no counter matching %s" % counters)
 
-    return stored_primary_server
+    rates = get_counter_rates(data, host, port, names, 'counter_rate:' + ','.join(sorted(names)))
+    if not rates:
+        return exit_first_run()
 
+    total = sum(rates.values())
+    message = "Rate of %s: %.2f ps" % (counters, total)
+    message += performance_data(perf_data, [("%.2f" % total, "rate_total", warning, critical)] +
+                                [("%.2f" % rates[name], "'%s'" % name) for name in sorted(rates)])
+    return check_levels(total, warning, critical, message)
 
-def check_replica_primary(con, host, warning, critical, perf_data, replicaset, mongo_version):
+
+def get_stored_primary_server_name(host, port, replicaset, current_primary):
+    """ Return the primary of replicaset seen by the previous run against
+    host:port and store current_primary for the next one """
+    db = open_state_store(host, port)
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS replica_primary (replset TEXT PRIMARY KEY, server TEXT NOT NULL, ts REAL NOT NULL)")
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT server FROM replica_primary WHERE replset = ?", (replicaset,)).fetchone()
+            if row is None or row[0] != current_primary:
+                db.execute("INSERT OR REPLACE INTO replica_primary (replset, server, ts) VALUES (?, ?, ?)", (replicaset, current_primary, time.time()))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+    finally:
+        db.close()
+    return row and row[0]
+
+
+def check_replica_primary(con, host, port, warning, critical, perf_data, replicaset):
     """ A function to check if the primary server of a replica set has changed """
     if warning is None and critical is None:
         warning = 1
@@ -1427,101 +3290,91 @@ def check_replica_primary(con, host, warning, critical, perf_data, replicaset, m
 
     primary_status = 0
     message = "Primary server has not changed"
-    db = con["nagios"]
     data = get_server_status(con)
     if replicaset != data['repl'].get('setName'):
         message = "Replica set requested: %s differs from the one found: %s" % (replicaset, data['repl'].get('setName'))
         primary_status = 2
         return check_levels(primary_status, warning, critical, message)
-    current_primary = data['repl'].get('primary')
-    saved_primary = get_stored_primary_server_name(db)
-    if current_primary is None:
-        current_primary = "None"
-    if saved_primary is None:
-        saved_primary = "None"
+    current_primary = data['repl'].get('primary') or "None"
+    saved_primary = get_stored_primary_server_name(host, port, replicaset, current_primary) or "None"
     if current_primary != saved_primary:
-        last_primary_server_record = {"server": current_primary}
-        if mongo_version == 2:
-            db.last_primary_server.update({"_id": "last_primary"}, {"$set": last_primary_server_record}, upsert=True)
-        else:
-            db.last_primary_server.update_one({"_id": "last_primary"}, {"$set": last_primary_server_record}, upsert=True)
         message = "Primary server has changed from %s to %s" % (saved_primary, current_primary)
         primary_status = 1
     return check_levels(primary_status, warning, critical, message)
 
 
-def check_page_faults(con, sample_time, warning, critical, perf_data):
-    warning = warning or 10
-    critical = critical or 20
-    try:
-        try:
-            set_read_preference(con.admin)
-            data1 = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
-            time.sleep(sample_time)
-            data2 = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
-        except:
-            data1 = con.admin.command(son.SON([('serverStatus', 1)]))
-            time.sleep(sample_time)
-            data2 = con.admin.command(son.SON([('serverStatus', 1)]))
-
-        try:
-            #on linux servers only
-            page_faults = (int(data2['extra_info']['page_faults']) - int(data1['extra_info']['page_faults'])) // sample_time
-        except KeyError:
-            print("WARNING - Can't get extra_info.page_faults counter from MongoDB")
-            sys.exit(1)
-
-        message = "Page Faults: %i" % (page_faults)
-
-        message += performance_data(perf_data, [(page_faults, "page_faults", warning, critical)])
-        check_levels(page_faults, warning, critical, message)
-
-    except Exception as e:
-        exit_with_general_critical(e)
-
-
-def chunks_balance(con, database, collection, warning, critical):
+def get_chunk_distribution(con):
+    """ Return {namespace: {shard: (chunks, jumbo chunks)}} of all sharded
+    collections, counted by the config server in one aggregation. Chunks
+    are keyed by the collection uuid from 5.0 on instead of its namespace. """
+    by_uuid = get_server_version(con) >= (5, 0)
+    pipeline = [{'$group': {'_id': {'ns': '$uuid' if by_uuid else '$ns', 'shard': '$shard'}, 'chunks': {'$sum': 1},
+                            'jumbo': {'$sum': {'$cond': [{'$eq': ['$jumbo', True]}, 1, 0]}}}}]
+    if by_uuid:
+        pipeline += [{'$lookup': {'from': 'collections', 'localField': '_id.ns', 'foreignField': 'uuid', 'as': 'collection'}},
+                     {'$project': {'_id': {'ns': {'$arrayElemAt': ['$collection._id', 0]}, 'shard': '$_id.shard'}, 'chunks': 1, 'jumbo': 1}}]
+    distribution = {}
+    for group in con.config.chunks.aggregate(pipeline):
+        distribution.setdefault(group['_id']['ns'], {})[group['_id']['shard']] = (group['chunks'], group['jumbo'])
+    return distribution
+
+
+def chunks_balance(con, pattern, warning, critical, perf_data, top=10):
+    """ Check the distribution of the chunks of all sharded collections whose
+    namespace matches pattern (all of them if None) over the shards which
+    are not being drained. The imbalance of a collection is the largest
+    difference of the chunks on a shard to the average, in percent of the
+    average; perf data is given for the top most imbalanced collections. """
     warning = warning or 10
     critical = critical or 20
-    nsfilter = database + "." + collection
     try:
-        try:
-            set_read_preference(con.admin)
-            col = con.config.chunks
-            nscount = col.find({"ns": nsfilter}).count()
-            shards = col.distinct("shard")
-
-        except:
-            print("WARNING - Can't get chunks infos from MongoDB")
-            sys.exit(1)
-
-        if nscount == 0:
-            print("WARNING - Namespace %s is not sharded" % (nsfilter))
-            sys.exit(1)
-
-        avgchunksnb = nscount // len(shards)
-        warningnb = avgchunksnb * warning // 100
-        criticalnb = avgchunksnb * critical // 100
-
-        for shard in shards:
-            delta = abs(avgchunksnb - col.find({"ns": nsfilter, "shard": shard}).count())
-            message = "Namespace: %s, Shard name: %s, Chunk delta: %i" % (nsfilter, shard, delta)
-
-            if delta >= criticalnb and delta > 0:
-                print("CRITICAL - Chunks not well balanced " + message)
-                sys.exit(2)
-            elif delta >= warningnb  and delta > 0:
-                print("WARNING - Chunks not well balanced  " + message)
-                sys.exit(1)
-
-        print("OK - Chunks well balanced across shards")
-        sys.exit(0)
-
+        distribution = get_chunk_distribution(con)
+        shards = [shard['_id'] for shard in con.config.shards.find({}, {'_id': 1, 'draining': 1}) if not shard.get('draining')]
     except Exception as e:
-        exit_with_general_critical(e)
-
-    print("OK - Chunks well balanced across shards")
-    sys.exit(0)
+        if is_timeout(e):
+            raise
+        print("WARNING - Can't get chunks infos from MongoDB: %s" % e)
+        return 1
+
+    regex = re.compile(pattern) if pattern else None
+    namespaces = sorted(namespace for namespace in distribution if namespace and (regex is None or regex.search(namespace)))
+    if not namespaces:
+        print("WARNING - No sharded collection matches %s" % pattern if pattern else "WARNING - No sharded collection found")
+        return 1
+
+    values = []
+    for namespace in namespaces:
+        counts = distribution[namespace]
+        chunks = sum(number for number, jumbo in counts.values())
+        jumbo = sum(jumbo for number, jumbo in counts.values())
+        average = float(chunks) / len(shards) if shards else 0
+        delta = max([abs(average - counts.get(shard, (0, 0))[0]) for shard in shards] or [0])
+        # less than one chunk off can not be balanced any better
+        imbalance = delta * 100 / average if delta >= 1 else 0
+        values.append((imbalance, namespace, chunks, jumbo))
+    values.sort(reverse=True)
+
+    problems = []
+    for imbalance, namespace, chunks, jumbo in values:
+        line = "Namespace: %s, %i chunks, %i jumbo, imbalance %.0f%%" % (namespace, chunks, jumbo, imbalance)
+        if imbalance >= critical:
+            problems.append((2, "CRITICAL - Chunks not well balanced " + line))
+        elif imbalance >= warning:
+            problems.append((1, "WARNING - Chunks not well balanced " + line))
+
+    states = [state for state, line in problems]
+    worst_state = max(states + [0], key=STATE_SEVERITY.index)
+    message = "%s - %i sharded collections on %i shards checked, %i critical, %i warning, %i jumbo chunks" % (
+        state_name(worst_state), len(values), len(shards), states.count(2), states.count(1), sum(value[3] for value in values))
+    perfdata = []
+    for imbalance, namespace, chunks, jumbo in values[:top]:
+        perfdata.append(("%.1f%%" % imbalance, "'%s_chunk_imbalance'" % namespace, warning, critical))
+        perfdata.append((jumbo, "'%s_jumbo_chunks'" % namespace))
+    message += performance_data(perf_data, perfdata)
+    print(message)
+    for state, line in sorted(problems, key=lambda problem: -problem[0]):
+        print(line)
+    return worst_state
 
 
 def check_connect_primary(con, warning, critical, perf_data):
@@ -1530,7 +3383,6 @@ def check_connect_primary(con, warning, critical, perf_data):
 
     try:
         try:
-            set_read_preference(con.admin)
             data = con.admin.command(pymongo.son_manipulator.SON([('isMaster', 1)]))
         except:
             data = con.admin.command(son.SON([('isMaster', 1)]))
@@ -1568,10 +3420,13 @@ def check_collection_state(con, database, collection):
         return exit_with_general_critical(e)
 
 
-def check_row_count(con, database, collection, warning, critical, perf_data):
+def check_row_count(con, host, port, database, collection, warning, critical, perf_data, mode="estimated", max_time_ms=10000, ttl=3600):
     try:
-        count = con[database][collection].count()
-        message = "Row count: %i" % (count)
+        if mode == "exact":
+            count, how = get_exact_count(con, host, port, database, collection, max_time_ms, ttl)
+        else:
+            count, how = estimated_count(read_database(con, database)[collection]), "estimated"
+        message = "Row count: %i (%s)" % (count, how)
         message += performance_data(perf_data, [(count, "row_count", warning, critical)])
 
         return check_levels(count, warning, critical, message)
@@ -1580,93 +3435,276 @@ def check_row_count(con, database, collection, warning, critical, perf_data):
         return exit_with_general_critical(e)
 
 
-def build_file_name(host, port, action):
+def estimated_count(collection):
+    """ Number of documents of collection taken from its metadata """
+    if hasattr(collection, 'estimated_document_count'):
+        # pymongo 3.7+
+        return collection.estimated_document_count()
+    return collection.count()
+
+
+def get_exact_count(con, host, port, database, collection, max_time_ms, ttl):
+    """ Return the number of documents of collection and how it was found.
+    A count is reused for ttl seconds; when counting takes longer than
+    max_time_ms the last count is used, or the estimate if there is none. """
+    name = "%s.%s" % (database, collection)
+    db = open_state_store(host, port)
+    try:
+        row = db.execute("SELECT value, ts FROM counters WHERE series = 'row_count' AND name = ?", (name,)).fetchone()
+        if row is not None and row[1] > time.time() - ttl:
+            return row[0], "exact, counted %is ago" % (time.time() - row[1])
+
+        target = read_database(con, database)[collection]
+        try:
+            if hasattr(target, 'count_documents'):
+                # pymongo 3.7+
+                count = target.count_documents({}, maxTimeMS=max_time_ms)
+            else:
+                count = target.find().max_time_ms(max_time_ms).count()
+        except pymongo.errors.ExecutionTimeout:
+            if row is not None:
+                return row[0], "exact count took over %i ms, counted %is ago" % (max_time_ms, time.time() - row[1])
+            return estimated_count(target), "estimated, exact count took over %i ms" % max_time_ms
+
+        db.execute("INSERT OR REPLACE INTO counters (series, name, value, ts) VALUES ('row_count', ?, ?, ?)", (name, count, time.time()))
+        return count, "exact"
+    finally:
+        db.close()
+
+
+def build_file_name(host, port, action, extension="data"):
     #done this way so it will work when run independently and from shell
     module_name = re.match('(.*//*)*(.*)\..*', __file__).group(2)
 
     if (port == 27017):
-        return "/tmp/" + module_name + "_data/" + host + "-" + action + ".data"
+        return "/tmp/" + module_name + "_data/" + host + "-" + action + "." + extension
     else:
-        return "/tmp/" + module_name + "_data/" + host + "-" + str(port) + "-" + action + ".data"
+        return "/tmp/" + module_name + "_data/" + host + "-" + str(port) + "-" + action + "." + extension
 
 
 def ensure_dir(f):
     d = os.path.dirname(f)
     if not os.path.exists(d):
-        os.makedirs(d)
+        try:
+            os.makedirs(d)
+        except OSError as e:
+            # created by a concurrent check in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def open_state_store(host, port):
+    """ Open the SQLite database keeping the state of all checks of host:port.
+    WAL mode lets concurrent checks read while another one is writing. """
+    file_name = build_file_name(host, port, "state", "db")
+    ensure_dir(file_name)
+    db = sqlite3.connect(file_name, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS counters (series TEXT NOT NULL, name TEXT NOT NULL, value NUMERIC NOT NULL, ts REAL NOT NULL, PRIMARY KEY (series, name))")
+    return db
 
 
-def write_values(file_name, string):
-    f = None
+#
+# Reverse DNS names (--rdns-lookup) are resolved at most once per run and
+# shared between runs for --rdns-cache-ttl seconds.
+#
+rdns_names = {}
+rdns_lock = threading.Lock()
+
+
+def open_rdns_cache():
+    file_name = build_file_name("rdns", 27017, "cache", "db")
+    ensure_dir(file_name)
+    db = sqlite3.connect(file_name, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS names (address TEXT PRIMARY KEY, name TEXT NOT NULL, ts REAL NOT NULL)")
+    return db
+
+
+def resolve_rdns(addresses, ttl=0):
+    """ Return a dict of the reverse DNS names of addresses. Addresses neither
+    resolved before in this run nor cached within ttl seconds are resolved
+    concurrently. """
+    with rdns_lock:
+        names = dict((address, rdns_names[address]) for address in addresses if address in rdns_names)
+    missing = sorted(set(addresses) - set(names))
+    if not missing:
+        return names
+
+    db = open_rdns_cache() if ttl > 0 else None
     try:
-        f = open(file_name, 'w')
-    except IOError as e:
-        #try creating
-        if (e.errno == 2):
-            ensure_dir(file_name)
-            f = open(file_name, 'w')
-        else:
-            raise IOError(e)
-    f.write(string)
-    f.close()
-    return 0
+        if db is not None:
+            for address in missing:
+                row = db.execute("SELECT name FROM names WHERE address = ? AND ts > ?", (address, time.time() - ttl)).fetchone()
+                if row is not None:
+                    names[address] = row[0]
+            missing = [address for address in missing if address not in names]
+
+        resolved = run_concurrently(lambda address: socket.getnameinfo((address, 0), 0)[0], missing, len(missing))
+        for address, name in zip(missing, resolved):
+            if isinstance(name, BaseException):
+                raise name
+            names[address] = name
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO names (address, name, ts) VALUES (?, ?, ?)", (address, name, time.time()))
+    finally:
+        if db is not None:
+            db.close()
+
+    with rdns_lock:
+        rdns_names.update(names)
+    return names
 
 
-def read_values(file_name):
-    data = None
+#
+# Counters of serverStatus the rate based actions need. A name ending with
+# a dot selects every counter below it.
+#
+OPCOUNTERS = ['insert', 'query', 'update', 'delete', 'getmore', 'command']
+
+RATE_COUNTERS = {
+    'opcounters': ['opcounters.', 'opcountersRepl.'],
+    'current_lock': ['globalLock.totalTime', 'globalLock.lockTime'],
+    'page_faults': ['extra_info.page_faults'],
+    'asserts': ['asserts.'],
+}
+
+
+def flatten_counters(data, prefix=""):
+    """ Return all numeric values of a nested serverStatus document by their dotted name """
+    counters = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            counters.update(flatten_counters(value, prefix + key + "."))
+        elif isinstance(value, numbers.Real) and not isinstance(value, bool):
+            counters[prefix + key] = value
+    return counters
+
+
+def select_counters(counters, names):
+    prefixes = tuple(name for name in names if name.endswith('.'))
+    return dict((name, value) for name, value in counters.items() if name in names or (prefixes and name.startswith(prefixes)))
+
+
+def server_uptime(data):
+    """ Uptime of the server in seconds, as exact as the server reports it """
+    return data.get('uptimeMillis', data['uptime'] * 1000) / 1000.0
+
+
+def get_counter_rates(data, host, port, names, series):
+    """ Return the per second rates of the serverStatus counters selected by
+    names since the previous run as a dict. Time is taken from the uptime of
+    the server, so a restart is detected by the uptime going backwards; the
+    rate is then the one since the restart. Counters without a previous
+    value have no rate yet. The samples are kept per series (the action), so
+    actions reading the same counters do not use up each other's samples.
+    The same snapshot seen again (from the serverStatus cache) gives the
+    rates computed for it before. """
+    counters = select_counters(flatten_counters(data), names)
+    uptime = server_uptime(data)
+    rates = {}
+    samples = []
+
+    db = open_state_store(host, port)
     try:
-        f = open(file_name, 'r')
-        data = f.read()
-        f.close()
-        return 0, data
-    except IOError as e:
-        if (e.errno == 2):
-            #no previous data
-            return 1, ''
-    except Exception as e:
-        return 2, None
-
-
-def calc_delta(old, new):
-    delta = []
-    if (len(old) != len(new)):
-        raise Exception("unequal number of parameters")
-    for i in range(0, len(old)):
-        val = float(new[i]) - float(old[i])
-        if val < 0:
-            val = new[i]
-        delta.append(val)
-    return 0, delta
-
-
-def maintain_delta(new_vals, host, port, action):
-    file_name = build_file_name(host, port, action)
-    err, data = read_values(file_name)
-    old_vals = data.split(';')
-    new_vals = [str(int(time.time()))] + new_vals
-    delta = None
+        # BEGIN IMMEDIATE takes the write lock before reading, so concurrent
+        # runs can not both read the same previous values
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            previous = dict((name, (value, ts)) for name, value, ts in db.execute("SELECT name, value, ts FROM counters WHERE series = ?", (series,)))
+            previous_rates = dict((name, (value, ts)) for name, value, ts in db.execute("SELECT name, value, ts FROM counters WHERE series = ?", (series + '/rate',)))
+            for name, value in counters.items():
+                if name in previous:
+                    old_value, old_uptime = previous[name]
+                    if uptime < old_uptime:
+                        # restarted, the counter started again from zero
+                        rates[name] = float(value) / uptime if uptime else 0.0
+                    elif uptime > old_uptime:
+                        delta = value - old_value
+                        if delta < 0:
+                            delta = value
+                        rates[name] = float(delta) / (uptime - old_uptime)
+                    else:
+                        # the same snapshot again, keep the older sample as
+                        # base for the next run and report the rate of then
+                        if name in previous_rates and previous_rates[name][1] == uptime:
+                            rates[name] = previous_rates[name][0]
+                        continue
+                    samples.append((series + '/rate', name, rates[name], uptime))
+                samples.append((series, name, value, uptime))
+            db.executemany("INSERT OR REPLACE INTO counters (series, name, value, ts) VALUES (?, ?, ?, ?)", samples)
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+    finally:
+        db.close()
+    return rates
+
+
+def oplog_collection_name(con):
+    """ Name of the oplog collection of the server of con, None without replication """
+    names = ['oplog.rs', 'oplog.$main']
+    if get_server_version(con) >= (3, 0):
+        data = con.local.command("listCollections", filter={'name': {'$in': names}}, nameOnly=True)
+        found = [info['name'] for info in data['cursor']['firstBatch']]
+    else:
+        found = [info['name'][len('local.'):] for info in con.local.system.namespaces.find({'name': {'$in': ['local.' + name for name in names]}})]
+    return ([name for name in names if name in found] + [None])[0]
+
+
+def oplog_first_ts(con, oplog):
+    return next(con.local[oplog].find({}, {'ts': 1}).sort("$natural", 1).limit(1))["ts"]
+
+
+def oplog_last_ts(con, oplog):
+    return next(con.local[oplog].find({}, {'ts': 1}).sort("$natural", -1).limit(1))["ts"]
+
+
+def replication_get_first_ts(con):
+    return oplog_first_ts(con, oplog_collection_name(con) or 'oplog.rs').time
+
+
+def cached_oplog_first(host, port, ttl, read_first):
+    """ Return the time of the first entry of the oplog of host:port, as
+    read_first() returns it in (err, first). It is read at most every ttl
+    seconds, the first entry moves only as fast as the oplog wraps around;
+    the last entry is cheap to read and must be current, so it is not kept.
+    Returns (err, first). """
+    db = open_state_store(host, port)
     try:
-        err, delta = calc_delta(old_vals, new_vals)
-    except:
-        err = 2
-    write_res = write_values(file_name, ";" . join(str(x) for x in new_vals))
-    return err + write_res, delta
-
-
-def replication_get_time_diff(con):
-    col = 'oplog.rs'
-    local = con.local
-    ol = local.system.namespaces.find_one({"name": "local.oplog.$main"})
-    if ol:
-        col = 'oplog.$main'
-    firstc = local[col].find().sort("$natural", 1).limit(1)
-    lastc = local[col].find().sort("$natural", -1).limit(1)
-    first = next(firstc)
-    last = next(lastc)
-    tfirst = first["ts"]
-    tlast = last["ts"]
-    delta = tlast.time - tfirst.time
-    return delta
+        stored = db.execute("SELECT value FROM counters WHERE series = 'oplog_window' AND name = 'first' AND ts > ?", (time.time() - ttl,)).fetchone()
+        if stored is not None:
+            return 0, stored[0]
+
+        err, first = read_first()
+        if err != 0:
+            return err, None
+        db.execute("INSERT OR REPLACE INTO counters (series, name, value, ts) VALUES ('oplog_window', 'first', ?, ?)", (first, time.time()))
+        return 0, first
+    finally:
+        db.close()
+
+
+def get_oplog_window(primary_name, primary_optime, ttl, connect_primary):
+    """ Return the time span in seconds of the oplog of the primary, from its
+    current optime (as reported by replSetGetStatus) and the first entry of
+    its oplog, read through the connection connect_primary(host, port)
+    returns. Returns (err, window). """
+    primary_host, primary_port = split_host_port(primary_name)
+    last = calendar.timegm(primary_optime.utctimetuple())
+
+    def read_first():
+        err, con = connect_primary(primary_host, primary_port or 27017)
+        if err != 0:
+            return err, None
+        return 0, replication_get_first_ts(con)
+    err, first = cached_oplog_first(primary_host, primary_port or 27017, ttl, read_first)
+    if err != 0:
+        return err, None
+    return 0, last - first
+
 
 #
 # main app